@@ -33,9 +33,9 @@ class ApiStack(Stack):
         )
 
         hotspot_api_lambda.add_environment("BUCKET_NAME", hotspot_stack.s3.bucket_name)
-        hotspot_api_lambda.add_environment("PAST_WEEK_PATH", "fresh/past_week.json")
-        hotspot_api_lambda.add_environment("PAST_MONTH_PATH", "fresh/past_month.json")
-        hotspot_api_lambda.add_environment("PAST_YEAR_PATH", "fresh/past_year.json")
+        hotspot_api_lambda.add_environment("ROLLUPS_PATH", "fresh/rollups")
+        hotspot_api_lambda.add_environment("SEGMENTS_PATH", "fresh/segments")
+        hotspot_api_lambda.add_environment("WINDOWS_PATH", "fresh/windows")
         hotspot_api_lambda.add_environment("LOG_LEVEL", "INFO")
         hotspot_api_lambda.add_environment("POWERTOOLS_LOGGER_SAMPLE_RATE", "0.1")
         hotspot_api_lambda.add_environment("POWERTOOLS_LOGGER_LOG_EVENT", "true")
@@ -44,5 +44,10 @@ class ApiStack(Stack):
         hotspot_api_lambda.role.attach_inline_policy(policy=hotspot_api_policy)
 
         hotspot_api_gateway = apigateway.LambdaRestApi(
-            self, "HotspotApiGateway", handler=hotspot_api_lambda, proxy=True
+            self,
+            "HotspotApiGateway",
+            handler=hotspot_api_lambda,
+            proxy=True,
+            # Parquet and pre-gzipped JSON are both returned base64-encoded
+            binary_media_types=["*/*"],
         )
@@ -11,6 +11,7 @@ from aws_cdk import (
     aws_ssm as ssm,
     aws_iam as iam,
     aws_athena as athena,
+    triggers,
 )
 import aws_cdk.aws_glue_alpha as glue
 
@@ -52,6 +53,17 @@ class HotspotStack(cdk.Stack):
             ),
         )
 
+        # Spotify artist metadata shared by every user's ingest, expired by
+        # DynamoDB once expires_at has passed
+        artist_table = aws_dynamodb.Table(
+            self,
+            "artist_table",
+            partition_key=aws_dynamodb.Attribute(
+                name="id", type=aws_dynamodb.AttributeType.STRING
+            ),
+            time_to_live_attribute="expires_at",
+        )
+
         glue_db = glue.Database(self, "hotspotdb", database_name="hotspot")
 
         ingest = _lambda.DockerImageFunction(
@@ -59,12 +71,16 @@ class HotspotStack(cdk.Stack):
             "ingest2",
             code=_lambda.DockerImageCode.from_image_asset("../lambda/ingest"),
             architecture=_lambda.Architecture.X86_64,
-            timeout=cdk.Duration.seconds(30),
+            # Room for backfill runs that follow many pages per user
+            timeout=cdk.Duration.minutes(5),
         )
 
         ingest.add_environment("WATERMARK_TABLE_NAME", watermark_table.table_name)
         ingest.add_environment("CACHE_TABLE_NAME", cache_table.table_name)
+        ingest.add_environment("ARTIST_TABLE_NAME", artist_table.table_name)
         ingest.add_environment("BUCKET_NAME", self.s3.bucket_name)
+        # "true" also archives the raw Spotify responses under raw/
+        ingest.add_environment("ARCHIVE_RAW", "false")
         ingest.add_environment("SPOTIPY_CLIENT_ID", spotipy_client_id)
         ingest.add_environment("SPOTIPY_CLIENT_SECRET", spotipy_client_secret)
         ingest.add_environment("SPOTIPY_REDIRECT_URI", spotipy_redirect_uri)
@@ -74,6 +90,13 @@ class HotspotStack(cdk.Stack):
         cache_table.grant_write_data(ingest)
         watermark_table.grant_read_data(ingest)
         cache_table.grant_read_data(ingest)
+        artist_table.grant_read_write_data(ingest)
+
+        # The plays table, partitioned by user_name/year/month. Compact
+        # migrates the plays written under plays/, partitioned by user_name
+        # only, to it.
+        legacy_plays_path = f"s3://{self.s3.bucket_name}/plays"
+        plays_path = f"s3://{self.s3.bucket_name}/plays_v2"
 
         transform = _lambda.DockerImageFunction(
             self,
@@ -90,6 +113,7 @@ class HotspotStack(cdk.Stack):
         )
         transform.add_environment("GLUE_TABLE_NAME", "plays")
         transform.add_environment("GLUE_DB_NAME", "hotspot")
+        transform.add_environment("PLAYS_PATH", plays_path)
         self.s3.grant_read_write(transform)
 
         notification = aws_s3_notifications.LambdaDestination(transform)
@@ -133,6 +157,7 @@ class HotspotStack(cdk.Stack):
                     resources=[
                         f"{self.s3.bucket_arn}",
                         f"{self.s3.bucket_arn}/plays/*",
+                        f"{self.s3.bucket_arn}/plays_v2/*",
                         f"arn:aws:glue:{self.region}:{self.account}:table/{glue_db.database_name}/plays",
                         f"{glue_db.database_arn}",
                         f"{glue_db.catalog_arn}",
@@ -161,17 +186,13 @@ class HotspotStack(cdk.Stack):
         prep_hotspot_api_lambda.add_environment("GLUE_TABLE", "plays")
         prep_hotspot_api_lambda.add_environment("GLUE_DB", "hotspot")
         prep_hotspot_api_lambda.add_environment("BUCKET_NAME", self.s3.bucket_name)
-        prep_hotspot_api_lambda.add_environment(
-            "PAST_WEEK_PATH", "fresh/past_week.json"
-        )
-        prep_hotspot_api_lambda.add_environment(
-            "PAST_MONTH_PATH", "fresh/past_month.json"
-        )
-        prep_hotspot_api_lambda.add_environment(
-            "PAST_YEAR_PATH", "fresh/past_year.json"
-        )
-        prep_hotspot_api_lambda.add_environment("FULL_DF_PATH", "fresh/all.json")
+        prep_hotspot_api_lambda.add_environment("ROLLUPS_PATH", "fresh/rollups")
+        prep_hotspot_api_lambda.add_environment("SEGMENTS_PATH", "fresh/segments")
+        prep_hotspot_api_lambda.add_environment("WINDOWS_PATH", "fresh/windows")
         prep_hotspot_api_lambda.add_environment("WORKGROUP", athena_workgroup.name)
+        # athena, or duckdb to scan PLAYS_PATH in process
+        prep_hotspot_api_lambda.add_environment("QUERY_BACKEND", "athena")
+        prep_hotspot_api_lambda.add_environment("PLAYS_PATH", plays_path)
         prep_hotspot_api_lambda.role.attach_inline_policy(hotspot_user_policy)
 
         prep_hotspot_api_cron = events.Rule(
@@ -184,3 +205,57 @@ class HotspotStack(cdk.Stack):
         prep_hotspot_api_cron.add_target(
             targets.LambdaFunction(prep_hotspot_api_lambda)
         )
+
+        compact_lambda = _lambda.DockerImageFunction(
+            self,
+            "CompactLambda",
+            code=_lambda.DockerImageCode.from_image_asset("../lambda/compact"),
+            architecture=_lambda.Architecture.X86_64,
+            memory_size=1024,
+            timeout=cdk.Duration.minutes(15),
+        )
+        compact_lambda.add_environment("GLUE_TABLE", "plays")
+        compact_lambda.add_environment("GLUE_DB", "hotspot")
+        compact_lambda.add_environment("LEGACY_PLAYS_PATH", legacy_plays_path)
+        compact_lambda.add_environment("PLAYS_PATH", plays_path)
+        compact_lambda.role.add_managed_policy(
+            policy=iam.ManagedPolicy.from_aws_managed_policy_name(
+                "service-role/AWSGlueServiceRole"
+            )
+        )
+        self.s3.grant_read_write(compact_lambda)
+        self.s3.grant_delete(compact_lambda)
+        # A migration that runs out of time carries on in a new invocation.
+        # A policy of its own, as the role's default policy is a dependency of
+        # the function.
+        iam.Policy(
+            self,
+            "CompactSelfInvokePolicy",
+            statements=[
+                iam.PolicyStatement(
+                    actions=["lambda:InvokeFunction"],
+                    resources=[compact_lambda.function_arn],
+                )
+            ],
+        ).attach_to_role(compact_lambda.role)
+
+        # Daily, away from the prep runs at five past every sixth hour
+        compact_cron = events.Rule(
+            self,
+            "CompactCron",
+            schedule=events.Schedule.cron(
+                minute="35", hour="3", day="*", month="*", year="*"
+            ),
+        )
+        compact_cron.add_target(targets.LambdaFunction(compact_lambda))
+
+        # Start the migration to plays_path on deploy rather than with the
+        # cron. Each invocation copies batches until its time runs short, so
+        # the deploy does not wait for it.
+        triggers.Trigger(
+            self,
+            "CompactOnDeploy",
+            handler=compact_lambda,
+            invocation_type=triggers.InvocationType.EVENT,
+            execute_after=[transform],
+        )
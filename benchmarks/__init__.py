@@ -0,0 +1 @@
+"""Synthetic data and benchmarks for the Hotspot compute path."""
@@ -0,0 +1,188 @@
+"""Time and memory-profile the dashboard compute path on synthetic plays.
+
+Results are written to benchmarks/results/ named after the current commit, so
+runs on different commits can be compared:
+
+    python -m benchmarks.run --rows 100000 1000000 --users 5 20
+    python -m benchmarks.run --rows 1000000 --compare benchmarks/results/<run>.json
+"""
+
+import argparse
+import json
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+from functools import partial
+from pathlib import Path
+from typing import Callable
+
+import numpy as np
+import pandas as pd
+
+from benchmarks.synthetic import default_range, make_plays
+from hotspot import compute_dashboard, compute_date_indices
+from lib.utils import (
+    PlaysView,
+    RollupView,
+    Rollups,
+    build_plays,
+    get_all_tracks,
+    get_latest_tracks,
+    get_listens_by_hour_of_day,
+    get_listens_per_day,
+    get_metrics,
+    get_top_albums,
+    get_top_artists,
+    get_top_genres,
+    get_top_tracks,
+)
+
+sys.path.insert(0, str(Path(__file__).parents[1] / "lambda"))
+from prep_hotspot_api.prep_hotspot_api import build_rollups  # noqa: E402
+
+RESULTS_DIR = Path(__file__).parent / "results"
+VIEW_FUNCTIONS = [
+    get_top_artists,
+    get_top_tracks,
+    get_top_albums,
+    get_top_genres,
+    get_metrics,
+]
+
+
+def measure(fn: Callable, repeat: int) -> dict:
+    """Best wall time of ``repeat`` runs and peak traced memory of one more."""
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - started)
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"seconds": min(times), "peak_mb": peak / 2**20}
+
+
+def get_cases(df: pd.DataFrame, days: int) -> dict[str, Callable]:
+    """Benchmark cases for one synthetic frame, keyed by name."""
+    start, end = default_range(df, days)
+    user_names = df["user_name"].unique().tolist()
+    dates_index, _ = compute_date_indices(start, end)
+    plays = build_plays(df)
+    compact = build_plays(df, compact=True)
+    rollups = Rollups(tables=build_rollups(df))
+
+    cases = {
+        "build_plays": partial(build_plays, df),
+        "build_plays_compact": partial(build_plays, df, compact=True),
+        "build_rollups": partial(build_rollups, df),
+        "compute_date_indices": partial(compute_date_indices, start, end),
+    }
+    views = {
+        "plays": partial(PlaysView, plays, user_names, start, end),
+        "compact": partial(PlaysView, compact, user_names, start, end),
+        "rollups": partial(RollupView, rollups, user_names, start, end),
+    }
+    for label, make_view in views.items():
+        # Per-function cases share one view, like a dashboard rerun does
+        view = make_view()
+        cases[f"{label}/view"] = make_view
+        for fn in VIEW_FUNCTIONS:
+            cases[f"{label}/{fn.__name__}"] = partial(fn, view)
+        cases[f"{label}/get_listens_per_day"] = partial(
+            get_listens_per_day, view, dates_index
+        )
+        cases[f"{label}/compute_dashboard"] = lambda make_view=make_view: (
+            compute_dashboard(make_view(), dates_index)
+        )
+
+    view = views["plays"]()
+    cases["plays/get_all_tracks"] = partial(get_all_tracks, view)
+    cases["plays/get_listens_by_hour_of_day"] = partial(
+        get_listens_by_hour_of_day, view, len(view)
+    )
+    cases["plays/get_latest_tracks"] = partial(get_latest_tracks, view)
+    return cases
+
+
+def git_commit() -> str:
+    try:
+        commit = subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], text=True
+        ).strip()
+        dirty = subprocess.check_output(["git", "status", "--porcelain"], text=True)
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+    return f"{commit}-dirty" if dirty.strip() else commit
+
+
+def run(
+    rows: int, users: int, artists: int, genres: int, days: int, repeat: int
+) -> dict:
+    df = make_plays(rows=rows, users=users, artists=artists, genres=genres, days=days)
+    results = {}
+    for name, fn in get_cases(df, days).items():
+        results[name] = measure(fn, repeat)
+        print(
+            f"{name:<40} {results[name]['seconds']:>10.4f}s"
+            f" {results[name]['peak_mb']:>10.1f}MB"
+        )
+    return {
+        "commit": git_commit(),
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "numpy": np.__version__,
+        "params": {
+            "rows": rows,
+            "users": users,
+            "artists": artists,
+            "genres": genres,
+            "days": days,
+            "repeat": repeat,
+        },
+        "results": results,
+    }
+
+
+def compare(record: dict, baseline: dict) -> None:
+    print(f"\n{'case':<40} {'baseline':>10} {'current':>10} {'ratio':>8}")
+    for name, result in record["results"].items():
+        if name not in baseline["results"]:
+            continue
+        before = baseline["results"][name]["seconds"]
+        print(
+            f"{name:<40} {before:>10.4f} {result['seconds']:>10.4f}"
+            f" {result['seconds'] / before:>8.2f}"
+        )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, nargs="+", default=[100_000])
+    parser.add_argument("--users", type=int, nargs="+", default=[5])
+    parser.add_argument("--artists", type=int, default=5_000)
+    parser.add_argument("--genres", type=int, default=1_000)
+    parser.add_argument("--days", type=int, default=365)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--compare", type=Path, help="Earlier results file")
+    args = parser.parse_args()
+
+    RESULTS_DIR.mkdir(exist_ok=True)
+    for rows in args.rows:
+        for users in args.users:
+            print(f"\n{rows} rows, {users} users")
+            record = run(rows, users, args.artists, args.genres, args.days, args.repeat)
+            path = RESULTS_DIR / f"{record['commit']}-{rows}r-{users}u.json"
+            path.write_text(json.dumps(record, indent=2))
+            print(f"Results written to {path}")
+            if args.compare:
+                compare(record, json.loads(args.compare.read_text()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""Synthetic plays frames in the schema returned by load_data."""
+
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+from config import USERS
+from lib.utils import add_calendar_columns
+
+IMAGE_URL = "https://i.scdn.co/image/ab6761610000e5eb{:024x}"
+
+
+def _zipf_choice(
+    rng: np.random.Generator, n: int, size: int, a: float = 1.1
+) -> np.ndarray:
+    """Draw ``size`` ids in ``range(n)`` with a long-tailed popularity."""
+    weights = 1.0 / np.arange(1, n + 1) ** a
+    return rng.choice(n, size=size, p=weights / weights.sum())
+
+
+def make_plays(
+    rows: int = 100_000,
+    users: int = len(USERS),
+    artists: int = 5_000,
+    genres: int = 1_000,
+    days: int = 365,
+    end: datetime | None = None,
+    seed: int = 0,
+) -> pd.DataFrame:
+    """Random plays with realistic cardinalities, as load_data returns them.
+
+    Artist popularity is long-tailed, each artist has up to three genres, a
+    handful of albums and a dozen tracks per album. Rows are not sorted, like
+    the API's payload.
+
+    Args:
+        rows: Number of plays
+        users: Number of users, named after config.USERS where possible
+        artists: Number of distinct artists
+        genres: Size of the genre vocabulary
+        days: Time span the plays are spread over, ending at ``end``
+        end: Latest possible play, defaults to now
+        seed: Random seed
+    """
+    rng = np.random.default_rng(seed)
+    end = end or datetime.now()
+    user_names = np.array(
+        (USERS + [f"user{i}" for i in range(len(USERS), users)])[:users],
+        dtype=object,
+    )
+
+    # Per-artist attributes
+    artist_names = np.array([f"artist {i}" for i in range(artists)], dtype=object)
+    artist_images = np.array(
+        [IMAGE_URL.format(i) for i in range(artists)], dtype=object
+    )
+    genre_names = np.array([f"genre {i}" for i in range(genres)], dtype=object)
+    artist_genres = np.array(
+        [
+            ";".join(genre_names[_zipf_choice(rng, genres, rng.integers(0, 4))])
+            for _ in range(artists)
+        ],
+        dtype=object,
+    )
+
+    # Tracks belong to albums, albums to artists
+    artist = _zipf_choice(rng, artists, rows)
+    album = artist * 4 + rng.integers(0, 4, rows)
+    track = album * 12 + rng.integers(0, 12, rows)
+    albums, album_codes = np.unique(album, return_inverse=True)
+    tracks, track_codes = np.unique(track, return_inverse=True)
+
+    seconds = rng.integers(0, days * 86400, rows)
+    played_at = pd.Timestamp(end, tz="UTC") - pd.to_timedelta(seconds, unit="s")
+
+    df = pd.DataFrame(
+        {
+            "name": np.array([f"track {t}" for t in tracks], dtype=object)[track_codes],
+            "artist_name": artist_names[artist],
+            "artist_image": artist_images[artist],
+            "album_name": np.array([f"album {a}" for a in albums], dtype=object)[
+                album_codes
+            ],
+            "album_image": np.array(
+                [IMAGE_URL.format((1 << 32) + a) for a in albums], dtype=object
+            )[album_codes],
+            "genres": artist_genres[artist],
+            "duration_ms": rng.integers(90_000, 360_000, rows),
+            "played_at": played_at,
+            "user_name": user_names[rng.integers(0, users, rows)],
+        }
+    )
+    return add_calendar_columns(df)
+
+
+def default_range(df: pd.DataFrame, days: int) -> tuple[datetime, datetime]:
+    """The dashboard's (start, end) for the last ``days`` of ``df``."""
+    end = df["played_at"].max().to_pydatetime()
+    start = datetime.combine((end - timedelta(days=days)).date(), datetime.min.time())
+    return start, datetime.combine(end.date(), datetime.max.time()) + timedelta(days=1)
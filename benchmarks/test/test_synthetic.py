@@ -0,0 +1,17 @@
+from benchmarks.run import get_cases, measure
+from benchmarks.synthetic import make_plays
+
+
+def test_make_plays_schema():
+    df = make_plays(rows=1_000, users=7, artists=50, genres=20, days=30)
+    assert len(df) == 1_000
+    assert df["user_name"].nunique() == 7
+    assert df["artist_name"].nunique() <= 50
+    assert {"played_at", "date", "hour", "dayofweek", "genres"} <= set(df.columns)
+
+
+def test_cases_run():
+    df = make_plays(rows=1_000, artists=50, genres=20, days=30)
+    cases = get_cases(df, days=30)
+    result = measure(cases["compact/compute_dashboard"], repeat=1)
+    assert result["seconds"] > 0
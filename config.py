@@ -14,6 +14,13 @@ USER_COLOURS = {
 TOP_ITEMS_LIMIT = 10
 ROLLING_WINDOW_DAYS = 14
 
+# Data loading
+COMPACT_PLAYS = True
+# Answer the dashboard from the daily rollups instead of raw plays. The
+# rollups hold every user and are downloaded whole, so the default is the plays
+# path, which fetches only the selected users and revalidates by ETag.
+USE_ROLLUPS = False
+
 # Date defaults
 DEFAULT_LOOKBACK_DAYS = 365
 
@@ -6,10 +6,12 @@ import pandas as pd
 import streamlit as st
 
 from config import (
+    COMPACT_PLAYS,
     DEFAULT_LOOKBACK_DAYS,
     PAGE_ICON,
     PAGE_TITLE,
     TOP_ITEMS_LIMIT,
+    USE_ROLLUPS,
     USERS,
 )
 from components.cards import render_top_items
@@ -20,13 +22,18 @@ from components.charts import (
     create_monthly_distribution_chart,
 )
 from lib.utils import (
-    get_all_tracks,
+    PlaysView,
+    RollupView,
+    View,
     get_listens_per_day,
+    get_metrics,
     get_top_albums,
     get_top_artists,
     get_top_genres,
     get_top_tracks,
     load_data,
+    load_rollups,
+    local_now,
 )
 
 st.set_page_config(
@@ -38,21 +45,22 @@ st.set_page_config(
 
 def render_date_selector() -> tuple[datetime, datetime]:
     """Render date range selector and return start/end datetimes."""
+    now = local_now()
     with st.container(horizontal=True):
         date_columns = st.columns(2, gap="medium", width=500)
         with date_columns[0]:
             start_date = st.date_input(
                 "Select start date:",
-                value=datetime.now() - timedelta(days=DEFAULT_LOOKBACK_DAYS),
-                min_value=datetime.now() - timedelta(days=DEFAULT_LOOKBACK_DAYS),
-                max_value=datetime.now(),
+                value=now - timedelta(days=DEFAULT_LOOKBACK_DAYS),
+                min_value=now - timedelta(days=DEFAULT_LOOKBACK_DAYS),
+                max_value=now,
             )
         with date_columns[1]:
             end_date = st.date_input(
                 "Select end date:",
-                value=datetime.now(),
+                value=now,
                 min_value=start_date + timedelta(days=1),
-                max_value=datetime.now(),
+                max_value=now,
             )
 
     start = datetime.combine(start_date, datetime.min.time())
@@ -109,6 +117,18 @@ def compute_date_indices(
     return dates_index, month_years
 
 
+def compute_dashboard(view: View, dates_index: pd.DataFrame) -> dict:
+    """Compute every table the dashboard renders for the selected plays."""
+    return {
+        "top_artists": get_top_artists(view),
+        "top_tracks": get_top_tracks(view),
+        "top_albums": get_top_albums(view),
+        "top_genres": get_top_genres(view),
+        "listens_per_day": get_listens_per_day(view, dates_index=dates_index),
+        "metrics": get_metrics(view),
+    }
+
+
 def main() -> None:
     st.title(PAGE_TITLE)
 
@@ -120,47 +140,49 @@ def main() -> None:
 
     dates_index, month_years = compute_date_indices(start, end)
 
-    df = load_data()
-
     # Compute data
-    top_artists = get_top_artists(df=df, user_names=user_names, start=start, end=end)
-    top_tracks = get_top_tracks(df=df, user_names=user_names, start=start, end=end)
-    top_albums = get_top_albums(df=df, user_names=user_names, start=start, end=end)
-    top_genres = get_top_genres(df=df, user_names=user_names, start=start, end=end)
-    all_tracks = get_all_tracks(df=df, user_names=user_names, start=start, end=end)
-    listens_per_day = get_listens_per_day(
-        df=df, user_names=user_names, start=start, end=end, dates_index=dates_index
-    )
-
-    # Compute metrics
-    distinct_artists = len(set(top_artists["artist"].to_list()))
-    distinct_albums = len(set(top_albums["album_name"].to_list()))
-    num_tracks = all_tracks.shape[0]
-    duration_hrs = all_tracks["duration_ms"].sum() / 3600000
-
-    render_metrics(num_tracks, distinct_artists, distinct_albums, duration_hrs)
+    if USE_ROLLUPS:
+        view = RollupView(
+            rollups=load_rollups(), user_names=user_names, start=start, end=end
+        )
+    else:
+        view = PlaysView(
+            plays=load_data(
+                compact=COMPACT_PLAYS,
+                lookback_days=DEFAULT_LOOKBACK_DAYS,
+                users=user_names,
+            ),
+            user_names=user_names,
+            start=start,
+            end=end,
+        )
+    data = compute_dashboard(view, dates_index)
+
+    render_metrics(**data["metrics"])
 
     # Charts row 1
     cols = st.columns(2)
     with cols[0].container(border=True, height="stretch"):
         st.text("Listens per day")
-        st.altair_chart(create_listens_per_day_chart(listens_per_day))
+        st.altair_chart(create_listens_per_day_chart(data["listens_per_day"]))
 
     with cols[1].container(border=True, height="stretch"):
         st.text("Genres")
-        st.altair_chart(create_genres_chart(top_genres))
+        st.altair_chart(create_genres_chart(data["top_genres"]))
 
     # Distribution charts (only for multiple users)
     if len(user_names) > 1:
         cols = st.columns(2)
         with cols[0].container(border=True, height="stretch"):
             st.text("Listen Distribution")
-            st.altair_chart(create_listen_distribution_pie_chart(listens_per_day))
+            st.altair_chart(
+                create_listen_distribution_pie_chart(data["listens_per_day"])
+            )
 
         with cols[1].container(border=True, height="stretch"):
             st.text("Monthly Listen Distribution")
             st.altair_chart(
-                create_monthly_distribution_chart(listens_per_day, month_years)
+                create_monthly_distribution_chart(data["listens_per_day"], month_years)
             )
 
     # Top items section
@@ -170,7 +192,7 @@ def main() -> None:
         with cols[0]:
             render_top_items(
                 title="Top Tracks",
-                items=top_tracks[:TOP_ITEMS_LIMIT].to_dict(orient="records"),
+                items=data["top_tracks"][:TOP_ITEMS_LIMIT].to_dict(orient="records"),
                 image_key="album_image",
                 primary_text_key="artist_name",
                 secondary_text_key="name",
@@ -180,7 +202,7 @@ def main() -> None:
         with cols[1]:
             render_top_items(
                 title="Top Artists",
-                items=top_artists[:TOP_ITEMS_LIMIT].to_dict(orient="records"),
+                items=data["top_artists"][:TOP_ITEMS_LIMIT].to_dict(orient="records"),
                 image_key="artist_image",
                 primary_text_key="artist",
                 secondary_text_key=None,
@@ -190,7 +212,7 @@ def main() -> None:
         with cols[2]:
             render_top_items(
                 title="Top Albums",
-                items=top_albums[:TOP_ITEMS_LIMIT].to_dict(orient="records"),
+                items=data["top_albums"][:TOP_ITEMS_LIMIT].to_dict(orient="records"),
                 image_key="album_image",
                 primary_text_key="artist_name",
                 secondary_text_key="album_name",
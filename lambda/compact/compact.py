@@ -0,0 +1,288 @@
+import hashlib
+import json
+import logging
+import os
+import time
+import uuid
+from collections.abc import Callable
+from datetime import datetime, timedelta, timezone
+from io import BytesIO
+
+import awswrangler as wr
+import boto3
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+boto3.setup_default_session(region_name="eu-west-1")
+s3 = boto3.client("s3")
+
+# Must match PARTITION_COLS in lambda/transform/transform.py
+PARTITION_COLS = ["user_name", "year", "month"]
+# Partitions with fewer parquet files than this are left as they are
+MIN_FILES = 2
+ROW_GROUP_SIZE = 128 * 1024
+# A month's partition is closed this long after the month ends, once late
+# plays from the last hourly ingest have landed
+CLOSED_AFTER = timedelta(days=1)
+
+
+def get_closed_partitions(partitions: dict[str, list[str]], now: datetime) -> list[str]:
+    """Locations of the partitions transform no longer appends to.
+
+    ``partitions`` maps location to partition values (user_name, year,
+    month), as returned by wr.catalog.get_partitions.
+    """
+    closed = []
+    for location, (_, year, month) in partitions.items():
+        month_end = pd.Timestamp(year=int(year), month=int(month), day=1, tz="UTC")
+        month_end += pd.offsets.MonthBegin(1)
+        if month_end + CLOSED_AFTER <= now:
+            closed.append(location)
+    return sorted(closed)
+
+
+def compact_partition(path: str) -> str | None:
+    """Rewrite the parquet files under ``path`` as one file sorted by played_at.
+
+    S3 cannot swap objects atomically, so the compacted file is written before
+    the small files are deleted in one batch. Readers never miss a play, but a
+    query running between the two steps can see the partition twice.
+    Returns the compacted file's path, or None if there was nothing to do.
+    """
+    files = wr.s3.list_objects(path, suffix=".parquet")
+    if len(files) < MIN_FILES:
+        return None
+
+    df = wr.s3.read_parquet(files).sort_values(
+        "played_at", kind="stable", ignore_index=True
+    )
+    buffer = BytesIO()
+    pq.write_table(
+        pa.Table.from_pandas(df, preserve_index=False),
+        buffer,
+        row_group_size=ROW_GROUP_SIZE,
+        compression="snappy",
+        # Match the millisecond timestamps awswrangler writes
+        coerce_timestamps="ms",
+        allow_truncated_timestamps=True,
+    )
+    buffer.seek(0)
+    compacted_path = f"{path.rstrip('/')}/compacted-{uuid.uuid4().hex}.parquet"
+    wr.s3.upload(local_file=buffer, path=compacted_path)
+    wr.s3.delete_objects(files)
+    logger.info(f"Compacted {len(files)} files ({len(df)} rows) into {compacted_path}")
+    return compacted_path
+
+
+def get_partition_keys(glue_db: str, glue_table: str) -> list[str] | None:
+    """The table's partition keys, or None if there is no such table."""
+    if not wr.catalog.does_table_exist(database=glue_db, table=glue_table):
+        return None
+    columns = wr.catalog.table(database=glue_db, table=glue_table)
+    return columns.loc[columns["Partition"], "Column Name"].tolist()
+
+
+# Plays transform wrote before the table was partitioned by month sit directly
+# under LEGACY_PLAYS_PATH/user_name=.../ and are copied in batches of this many
+# files, oldest first
+MIGRATION_BATCH_FILES = 500
+# S3 modification times are to the second, so files newer than this could
+# still be followed by ones sorting before them, and wait for the next listing
+MIGRATION_SETTLE = timedelta(minutes=1)
+# Time an invocation keeps back for a batch and the compaction that follows
+MIGRATION_MARGIN_MS = 120_000
+MIGRATION_STATE = "_migration.json"
+
+
+def list_legacy_files(
+    legacy_path: str, after: list[str] | None, before: datetime
+) -> list[tuple[str, str]]:
+    """(ISO modification time, path) of the legacy layout's files modified
+    after ``after`` and before ``before``, oldest first."""
+    bucket, prefix = legacy_path.removeprefix("s3://").split("/", 1)
+    prefix = f"{prefix.rstrip('/')}/"
+    files = []
+    paginator = s3.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get("Contents", []):
+            key = obj["Key"]
+            # user_name=.../file.parquet, not the month partitions under it
+            if not key.endswith(".parquet") or key[len(prefix) :].count("/") != 1:
+                continue
+            if obj["LastModified"] >= before:
+                continue
+            file = (obj["LastModified"].isoformat(), f"s3://{bucket}/{key}")
+            if after is None or file > tuple(after):
+                files.append(file)
+    return sorted(files)
+
+
+def copy_legacy_files(
+    files: list[str], legacy_path: str, plays_path: str
+) -> dict[str, list[str]]:
+    """Write the plays of ``files`` under ``plays_path`` in the PARTITION_COLS
+    layout. Returns the partitions written, by location.
+
+    File names derive from ``files``, so copying a batch again overwrites it.
+    """
+    df = wr.s3.read_parquet(files, dataset=True, path_root=legacy_path)
+    df["user_name"] = df["user_name"].astype(str)
+    df = df.assign(year=df["played_at"].dt.year, month=df["played_at"].dt.month)
+    batch = hashlib.md5("\n".join(files).encode()).hexdigest()
+    res = wr.s3.to_parquet(
+        df=df,
+        path=plays_path,
+        mode="append",
+        dataset=True,
+        partition_cols=PARTITION_COLS,
+        filename_prefix=f"migrated-{batch}",
+    )
+    return res["partitions_values"]
+
+
+def swap_table(glue_db: str, glue_table: str, plays_path: str) -> None:
+    """Re-create the table over ``plays_path``, partitioned by PARTITION_COLS.
+
+    Glue cannot change a table's partition keys or location in place. Only
+    the catalog changes, so a swap that fails is run again by the next
+    migration, and the legacy files stay where they were.
+    """
+    files = wr.s3.list_objects(plays_path, suffix=".parquet")
+    partitions = {
+        f"{file.rsplit('/', 1)[0]}/": [
+            part.split("=", 1)[1]
+            for part in file[len(plays_path.rstrip("/")) + 1 :].split("/")[:-1]
+        ]
+        for file in files
+    }
+    columns_types, _ = wr.s3.read_parquet_metadata(files[0])
+    # Match the types transform's writes register
+    partitions_types = {"user_name": "string", "year": "int", "month": "int"}
+    if get_partition_keys(glue_db, glue_table) not in (None, PARTITION_COLS):
+        wr.catalog.delete_table_if_exists(database=glue_db, table=glue_table)
+    wr.catalog.create_parquet_table(
+        database=glue_db,
+        table=glue_table,
+        path=plays_path,
+        columns_types=columns_types,
+        partitions_types=partitions_types,
+        mode="overwrite",
+    )
+    wr.catalog.add_parquet_partitions(
+        database=glue_db, table=glue_table, partitions_values=partitions
+    )
+
+
+def _get_state_location(legacy_path: str) -> tuple[str, str]:
+    # Beside the legacy partitions rather than in the table read from
+    bucket, prefix = legacy_path.removeprefix("s3://").split("/", 1)
+    return bucket, f"{prefix.rstrip('/')}/{MIGRATION_STATE}"
+
+
+def read_migration_state(legacy_path: str) -> dict:
+    bucket, key = _get_state_location(legacy_path)
+    try:
+        obj = s3.get_object(Bucket=bucket, Key=key)
+    except s3.exceptions.NoSuchKey:
+        return {"after": None, "swapped_at": None, "done": False}
+    return json.loads(obj["Body"].read())
+
+
+def write_migration_state(legacy_path: str, state: dict) -> None:
+    bucket, key = _get_state_location(legacy_path)
+    s3.put_object(Bucket=bucket, Key=key, Body=json.dumps(state).encode())
+
+
+def migrate_table(
+    glue_db: str,
+    glue_table: str,
+    legacy_path: str,
+    plays_path: str,
+    has_time: Callable[[], bool] = lambda: True,
+) -> bool:
+    """Move the plays table from the user_name only layout under
+    ``legacy_path`` to PARTITION_COLS under ``plays_path``.
+
+    Legacy files are copied in batches, and their progress is recorded in
+    MIGRATION_STATE, so the migration resumes where a run stopped. The
+    table is swapped to ``plays_path`` once every file is copied. Until then
+    it serves the legacy files, which transform keeps appending to, and the
+    files transform wrote just before the swap are copied after it. Legacy
+    files are never deleted.
+    Returns whether the migration is done, False if it ran out of time.
+    """
+    state = read_migration_state(legacy_path)
+    while not state["done"]:
+        before = datetime.now(timezone.utc) - MIGRATION_SETTLE
+        files = list_legacy_files(legacy_path, state["after"], before)
+        for start in range(0, len(files), MIGRATION_BATCH_FILES):
+            if not has_time():
+                return False
+            batch = files[start : start + MIGRATION_BATCH_FILES]
+            partitions = copy_legacy_files(
+                [path for _, path in batch], legacy_path, plays_path
+            )
+            if state["swapped_at"] is not None:
+                wr.catalog.add_parquet_partitions(
+                    database=glue_db, table=glue_table, partitions_values=partitions
+                )
+            state["after"] = list(batch[-1])
+            write_migration_state(legacy_path, state)
+            logger.info(f"Migrated {len(batch)} legacy files up to {batch[-1]}")
+
+        if state["swapped_at"] is None:
+            if state["after"] is None:
+                # Nothing was ever written in the legacy layout
+                state["done"] = True
+            else:
+                swap_table(glue_db, glue_table, plays_path)
+                state["swapped_at"] = datetime.now(timezone.utc).isoformat()
+                logger.info(f"Swapped {glue_table} to {plays_path}")
+        elif not files and before.isoformat() > state["swapped_at"]:
+            # Every file transform wrote in the legacy layout is copied
+            state["done"] = True
+        write_migration_state(legacy_path, state)
+        if not state["done"]:
+            if not has_time():
+                return False
+            time.sleep(MIGRATION_SETTLE.total_seconds())
+    return True
+
+
+def lambda_handler(event, context):
+    logger.info(f"Received event: {event}")
+    glue_db = os.getenv("GLUE_DB", "")
+    glue_table = os.getenv("GLUE_TABLE", "")
+    legacy_path = os.getenv("LEGACY_PLAYS_PATH", "")
+    plays_path = os.getenv("PLAYS_PATH", "")
+
+    # Also run on deploy, so a table partitioned by user_name only is migrated
+    # without waiting for the daily run
+    done = migrate_table(
+        glue_db,
+        glue_table,
+        legacy_path,
+        plays_path,
+        lambda: context.get_remaining_time_in_millis() > MIGRATION_MARGIN_MS,
+    )
+    if not done:
+        # Carry on in a new invocation, and compact once the table is swapped
+        boto3.client("lambda").invoke(
+            FunctionName=context.invoked_function_arn,
+            InvocationType="Event",
+            Payload=json.dumps(event).encode(),
+        )
+        return "202"
+
+    partitions = wr.catalog.get_partitions(database=glue_db, table=glue_table)
+    compacted = [
+        compacted_path
+        for location in get_closed_partitions(partitions, datetime.now(timezone.utc))
+        if (compacted_path := compact_partition(location)) is not None
+    ]
+    logger.info(f"Compacted {len(compacted)} of {len(partitions)} partitions")
+    return "200"
@@ -0,0 +1,135 @@
+import os
+from datetime import datetime, timedelta, timezone
+from unittest.mock import MagicMock
+
+import awswrangler as wr
+import boto3
+import pandas as pd
+from mock import patch
+from moto import mock_aws
+
+os.environ.setdefault("AWS_ACCESS_KEY_ID", "testing")
+os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "testing")
+os.environ.setdefault("AWS_DEFAULT_REGION", "eu-west-1")
+
+from compact.compact import (
+    PARTITION_COLS,
+    compact_partition,
+    get_closed_partitions,
+    get_partition_keys,
+    migrate_table,
+    read_migration_state,
+)
+
+PATH = "s3://bucket-name/plays/user_name=Dan/year=2025/month=1/"
+
+
+def _get_plays(hours):
+    return pd.DataFrame(
+        {
+            "name": [f"track {hour}" for hour in hours],
+            "played_at": pd.to_datetime(
+                [f"2025-01-01 {hour:02}:00" for hour in hours], utc=True
+            ),
+        }
+    )
+
+
+def test_get_closed_partitions():
+    partitions = {
+        f"s3://bucket-name/plays/user_name=Dan/year={year}/month={month}/": [
+            "Dan",
+            year,
+            month,
+        ]
+        for year, month in [("2024", "12"), ("2025", "1"), ("2025", "2")]
+    }
+    closed = get_closed_partitions(
+        partitions, datetime(2025, 2, 1, 12, tzinfo=timezone.utc)
+    )
+    assert closed == ["s3://bucket-name/plays/user_name=Dan/year=2024/month=12/"]
+
+
+@mock_aws
+def test_compact_partition():
+    boto3.client("s3", region_name="eu-west-1").create_bucket(
+        Bucket="bucket-name",
+        CreateBucketConfiguration={"LocationConstraint": "eu-west-1"},
+    )
+    for i, hours in enumerate([[10, 11], [9], [12]]):
+        wr.s3.to_parquet(_get_plays(hours), f"{PATH}{i}.snappy.parquet")
+
+    compacted_path = compact_partition(PATH)
+    assert wr.s3.list_objects(PATH) == [compacted_path]
+    df = wr.s3.read_parquet(compacted_path)
+    assert df["played_at"].dt.hour.tolist() == [9, 10, 11, 12]
+
+    # A single file is already compact
+    assert compact_partition(PATH) is None
+
+
+LEGACY_PATH = "s3://bucket-name/plays/"
+PLAYS_PATH = "s3://bucket-name/plays_v2/"
+
+
+def _write_legacy_plays(plays):
+    # One file per play, as transform appends every landing object
+    for i in range(len(plays)):
+        wr.s3.to_parquet(
+            plays.iloc[i : i + 1],
+            LEGACY_PATH,
+            dataset=True,
+            mode="append",
+            partition_cols=["user_name"],
+            database="hotspot",
+            table="plays",
+        )
+
+
+@mock_aws
+@patch("compact.compact.MIGRATION_SETTLE", new=timedelta(0))
+@patch("compact.compact.MIGRATION_BATCH_FILES", new=2)
+@patch("compact.compact.time.sleep", new=MagicMock())
+def test_migrate_table_resumes_and_swaps():
+    boto3.client("s3", region_name="eu-west-1").create_bucket(
+        Bucket="bucket-name",
+        CreateBucketConfiguration={"LocationConstraint": "eu-west-1"},
+    )
+    wr.catalog.create_database("hotspot")
+    plays = pd.concat([_get_plays([9, 10]), _get_plays([11])], ignore_index=True)
+    plays["user_name"] = ["Dan", "Dan", "Theo"]
+    plays.loc[2, "played_at"] = pd.Timestamp("2024-12-31 23:00", tz="UTC")
+    _write_legacy_plays(plays)
+    legacy_files = wr.s3.list_objects(LEGACY_PATH, suffix=".parquet")
+
+    # Out of time after the first batch: the legacy table still serves reads
+    has_time = MagicMock(side_effect=[True, False])
+    assert not migrate_table("hotspot", "plays", LEGACY_PATH, PLAYS_PATH, has_time)
+    assert get_partition_keys("hotspot", "plays") == ["user_name"]
+    assert read_migration_state(LEGACY_PATH)["after"] is not None
+
+    assert migrate_table("hotspot", "plays", LEGACY_PATH, PLAYS_PATH)
+    assert get_partition_keys("hotspot", "plays") == PARTITION_COLS
+    location = wr.catalog.get_table_location(database="hotspot", table="plays")
+    assert location.rstrip("/") == PLAYS_PATH.rstrip("/")
+    assert sorted(wr.catalog.get_partitions("hotspot", "plays").values()) == [
+        ["Dan", "2025", "1"],
+        ["Theo", "2024", "12"],
+    ]
+    df = wr.s3.read_parquet_table(database="hotspot", table="plays")
+    assert sorted(df["name"]) == ["track 10", "track 11", "track 9"]
+    # The legacy files are left in place
+    assert wr.s3.list_objects(LEGACY_PATH, suffix=".parquet") == legacy_files
+    assert read_migration_state(LEGACY_PATH)["done"]
+
+
+@mock_aws
+def test_migrate_table_without_legacy_plays():
+    boto3.client("s3", region_name="eu-west-1").create_bucket(
+        Bucket="bucket-name",
+        CreateBucketConfiguration={"LocationConstraint": "eu-west-1"},
+    )
+    wr.catalog.create_database("hotspot")
+    assert get_partition_keys("hotspot", "plays") is None
+    assert migrate_table("hotspot", "plays", LEGACY_PATH, PLAYS_PATH)
+    assert read_migration_state(LEGACY_PATH)["done"]
@@ -1,12 +1,29 @@
 import os
+import base64
+import gzip
+import hashlib
+import time
 import requests
-from requests import Response
+from requests import Response as RequestsResponse
 import json
+from dataclasses import dataclass, field
+from datetime import datetime
+from email.utils import format_datetime
+from io import BytesIO
+from typing import Any, Callable
+from urllib.parse import unquote
+
+import pandas as pd
 
 from aws_lambda_powertools import Logger, Tracer
-from aws_lambda_powertools.event_handler import APIGatewayRestResolver
+from aws_lambda_powertools.event_handler import APIGatewayRestResolver, Response
+from aws_lambda_powertools.event_handler.exceptions import (
+    BadRequestError,
+    NotFoundError,
+)
 from aws_lambda_powertools.utilities.typing import LambdaContext
 import boto3
+from botocore.exceptions import ClientError
 
 tracer = Tracer()
 logger = Logger()
@@ -14,33 +31,479 @@ app = APIGatewayRestResolver()
 
 s3 = boto3.client("s3")
 
+PARQUET_CONTENT_TYPE = "application/vnd.apache.parquet"
+
+# Rollup tables and the key columns of the entity each one counts
+ROLLUPS = {
+    "days": [],
+    "genres": ["genre"],
+    "artists": ["artist_name", "artist_image"],
+    "albums": ["artist_name", "album_name", "album_image"],
+    "tracks": ["name", "artist_name", "album_image"],
+}
+DEFAULT_LOOKBACK_DAYS = 365
+DEFAULT_LIMIT = 10
+
+
+@dataclass
+class CachedObject:
+    """An S3 object body with its ETag and the values derived from it."""
+
+    etag: str
+    last_modified: datetime
+    body: bytes
+    checked_at: float
+    derived: dict = field(default_factory=dict)
+
+
+# S3 objects kept across warm invocations, keyed by S3 key
+_objects: dict[str, CachedObject] = {}
+
+
+def get_cached_object(key: str, immutable: bool = False) -> CachedObject:
+    """The object at ``key``, revalidated against S3 by ETag.
+
+    Within REVALIDATE_SECONDS of the last check the cached copy is used
+    without calling S3. After that a conditional GET only transfers the body
+    when the ETag has changed. ``immutable`` objects, the shards of closed
+    segments, are never revalidated.
+    """
+    cached = _objects.get(key)
+    if cached is not None and immutable:
+        return cached
+    revalidate_seconds = float(os.getenv("REVALIDATE_SECONDS", "60"))
+    if cached is not None and time.monotonic() - cached.checked_at < revalidate_seconds:
+        return cached
+
+    bucket_name = os.getenv("BUCKET_NAME", "")
+    conditional = {"IfNoneMatch": cached.etag} if cached is not None else {}
+    try:
+        obj = s3.get_object(Bucket=bucket_name, Key=key, **conditional)
+    except ClientError as e:
+        not_modified = e.response["ResponseMetadata"].get("HTTPStatusCode") == 304
+        if cached is None or not not_modified:
+            raise
+        cached.checked_at = time.monotonic()
+        return cached
+
+    cached = CachedObject(
+        etag=obj["ETag"],
+        last_modified=obj["LastModified"],
+        body=obj["Body"].read(),
+        checked_at=time.monotonic(),
+    )
+    _objects[key] = cached
+    return cached
+
+
+def derive(
+    key: str, name: str, fn: Callable[[bytes], Any], immutable: bool = False
+) -> Any:
+    """``fn`` applied to the body of the object at ``key``, once per ETag."""
+    cached = get_cached_object(key, immutable)
+    if name not in cached.derived:
+        cached.derived[name] = fn(cached.body)
+    return cached.derived[name]
+
+
+def read_parquet_cached(key: str, immutable: bool = False) -> pd.DataFrame:
+    return derive(key, "frame", lambda body: pd.read_parquet(BytesIO(body)), immutable)
+
+
+def get_rollups() -> dict[str, pd.DataFrame]:
+    rollups_path = os.getenv("ROLLUPS_PATH", "")
+    return {
+        name: read_parquet_cached(f"{rollups_path}/{name}.parquet") for name in ROLLUPS
+    }
+
+
+def wants_parquet() -> bool:
+    accept = app.current_event.headers.get("Accept") or ""
+    return PARQUET_CONTENT_TYPE in accept
+
+
+def serve_conditional(
+    obj: CachedObject, build: Callable[[], Response], etag: str | None = None
+) -> Response:
+    """``build()`` with validators for ``obj``, or 304 if the client has it.
+
+    ``etag`` overrides the object's own ETag for responses derived from it.
+    """
+    etag = etag or obj.etag
+    headers = {
+        "ETag": etag,
+        "Last-Modified": format_datetime(obj.last_modified, usegmt=True),
+    }
+    if_none_match = app.current_event.headers.get("If-None-Match") or ""
+    tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    if etag in tags or "*" in tags:
+        return Response(status_code=304, headers=headers, compress=False)
+    response = build()
+    response.headers.update(headers)
+    return response
+
+
+def accepts_gzip() -> bool:
+    accept_encoding = app.current_event.headers.get("Accept-Encoding") or ""
+    return "gzip" in accept_encoding
+
+
+def serve_gzip(body: str) -> Response:
+    """Serve a gzipped JSON response body, already base64-encoded for API
+    Gateway, without recompressing it."""
+    response = Response(
+        status_code=200,
+        content_type="application/json",
+        body=body,
+        headers={"Content-Encoding": "gzip"},
+        compress=False,
+    )
+    response.base64_encoded = True
+    return response
+
+
+def serve_frame(df: pd.DataFrame) -> Response:
+    """Serialise a frame the way its fresh/* object is stored."""
+    if wants_parquet():
+        return Response(
+            status_code=200,
+            content_type=PARQUET_CONTENT_TYPE,
+            body=df.to_parquet(index=False),
+            compress=False,
+        )
+    return Response(
+        status_code=200,
+        content_type="application/json",
+        body=f'{{"body": {df.to_json()}}}',
+    )
+
+
+def get_plays_query() -> dict:
+    """Parse the since, users and fields parameters of the fresh/* endpoints."""
+    params = app.current_event.query_string_parameters or {}
+    query = {}
+    if params.get("since") is not None:
+        try:
+            query["since"] = pd.Timestamp(int(params["since"]), unit="ms")
+        except ValueError as e:
+            raise BadRequestError(str(e))
+    if params.get("users"):
+        query["users"] = params["users"].split(",")
+    if params.get("fields"):
+        query["fields"] = params["fields"].split(",")
+    return query
+
+
+def filter_plays(df: pd.DataFrame, query: dict) -> pd.DataFrame:
+    """The rows and columns of ``df`` selected by a plays query."""
+    rows = pd.Series(True, index=df.index)
+    if "since" in query:
+        rows &= df["played_at"] > query["since"]
+    if "users" in query:
+        rows &= df["user_name"].isin(query["users"])
+    columns = query.get("fields", list(df.columns))
+    unknown = sorted(set(columns) - set(df.columns))
+    if unknown:
+        raise BadRequestError(f"Unknown fields {','.join(unknown)}")
+    return df.loc[rows, columns]
+
+
+def get_manifest_key() -> str:
+    return f"{os.getenv('SEGMENTS_PATH', '')}/manifest.json"
+
+
+def read_manifest() -> dict:
+    return derive(get_manifest_key(), "manifest", json.loads)
+
+
+def get_shard_key(name: str, user: str) -> str:
+    return f"{os.getenv('SEGMENTS_PATH', '')}/{name}/{user}.parquet"
+
+
+def assemble_window(manifest: dict, days: int, users: list[str] | None) -> pd.DataFrame:
+    """Plays of the last ``days`` days from the cached segment shards of
+    ``users`` (every user if None)."""
+    start = pd.Timestamp.now().normalize() - pd.Timedelta(days=days)
+    frames = [
+        read_parquet_cached(get_shard_key(segment["name"], user), segment["closed"])
+        for segment in manifest["segments"]
+        if pd.Timestamp(segment["end"]) > start
+        for user in segment["users"]
+        if users is None or user in users
+    ]
+    if not frames:
+        return pd.DataFrame({"played_at": pd.Series(dtype="datetime64[ns]")})
+    df = pd.concat(frames, ignore_index=True)
+    df = df[df["played_at"] > start]
+    return df.sort_values("played_at", kind="stable", ignore_index=True)
+
+
+def read_window(days: int, users: list[str] | None = None) -> pd.DataFrame:
+    """Plays of the last ``days`` days of ``users`` (every user if None).
+
+    The every-user window is cached until prep_hotspot_api publishes a new
+    manifest. A selection of users is assembled per request from the shards,
+    which are cached already, so arbitrary ``users`` values cannot grow the
+    cache.
+    """
+    if users is not None:
+        return assemble_window(read_manifest(), days, users)
+    return derive(
+        get_manifest_key(),
+        f"window-{days}",
+        lambda body: assemble_window(json.loads(body), days, None),
+    )
+
+
+def get_derived_etag(obj: CachedObject, suffix: str) -> str:
+    """A validator for a response derived from ``obj``."""
+    tag = obj.etag.strip('"')
+    return f'"{tag}-{suffix}"'
+
+
+def serve_json_object(key: str) -> Response:
+    """Serve a stored JSON object in the response envelope, without parsing it."""
+    return serve_conditional(
+        get_cached_object(key),
+        lambda: Response(
+            status_code=200,
+            content_type="application/json",
+            body=derive(key, "envelope", lambda body: f'{{"body": {body.decode()}}}'),
+        ),
+    )
+
+
+def get_window_key(days: int) -> str:
+    return f"{os.getenv('WINDOWS_PATH', '')}/{days}.json.gz"
+
+
+def serve_window_json(days: int) -> Response:
+    """Serve the gzipped JSON window prep_hotspot_api published, passing its
+    bytes through to clients that accept gzip."""
+    key = get_window_key(days)
+    obj = get_cached_object(key)
+    if accepts_gzip():
+        return serve_conditional(
+            obj,
+            lambda: serve_gzip(
+                derive(key, "base64", lambda body: base64.b64encode(body).decode())
+            ),
+        )
+    return serve_conditional(
+        obj,
+        lambda: Response(
+            status_code=200,
+            content_type="application/json",
+            body=derive(key, "json", lambda body: gzip.decompress(body).decode()),
+        ),
+        etag=get_derived_etag(obj, "identity"),
+    )
+
+
+def get_fresh(days: int):
+    """Serve the plays of the last ``days`` days as parquet if the client
+    accepts it, else JSON.
+
+    Unfiltered JSON is the window prep_hotspot_api published, gzipped. The
+    rest is assembled from the month segments, unfiltered parquet once per
+    manifest version.
+
+    The ``since`` (epoch ms), ``users`` and ``fields`` query parameters
+    select plays after a time, plays of some users and a subset of columns.
+    """
+    query = get_plays_query()
+    manifest_key = get_manifest_key()
+    if query:
+        manifest = get_cached_object(manifest_key)
+        df = read_window(days, query.get("users"))
+        # One validator per manifest version, query and representation
+        fmt = "parquet" if wants_parquet() else "json"
+        key = f"{days}{sorted(query.items())}{fmt}"
+        digest = hashlib.md5(key.encode()).hexdigest()
+        response = serve_conditional(
+            manifest,
+            lambda: serve_frame(filter_plays(df, query)),
+            etag=get_derived_etag(manifest, digest),
+        )
+    elif wants_parquet():
+        manifest = get_cached_object(manifest_key)
+        body = derive(
+            manifest_key,
+            f"window-{days}-parquet",
+            lambda _: read_window(days).to_parquet(index=False),
+        )
+        response = serve_conditional(
+            manifest,
+            lambda: Response(
+                status_code=200,
+                content_type=PARQUET_CONTENT_TYPE,
+                body=body,
+                compress=False,
+            ),
+            etag=get_derived_etag(manifest, str(days)),
+        )
+    else:
+        response = serve_window_json(days)
+    # The representation depends on both headers
+    response.headers["Vary"] = "Accept, Accept-Encoding"
+    return response
+
+
+@app.get("/segments")
+@tracer.capture_method(capture_response=False)
+def get_segments():
+    return serve_json_object(get_manifest_key())
+
+
+@app.get("/segments/<name>/<user>")
+@tracer.capture_method(capture_response=False)
+def get_segment_shard(name: str, user: str):
+    user = unquote(user)
+    segments = {segment["name"]: segment for segment in read_manifest()["segments"]}
+    if name not in segments or user not in segments[name]["users"]:
+        raise NotFoundError(f"Unknown segment shard {name}/{user}")
+    # Closed segments are never rewritten, so neither the API nor clients
+    # check them again
+    obj = get_cached_object(get_shard_key(name, user), segments[name]["closed"])
+    cache_control = (
+        "public, max-age=31536000, immutable"
+        if segments[name]["closed"]
+        else "no-cache"
+    )
+    return serve_conditional(
+        obj,
+        lambda: Response(
+            status_code=200,
+            content_type=PARQUET_CONTENT_TYPE,
+            body=obj.body,
+            headers={"Cache-Control": cache_control},
+            compress=False,
+        ),
+    )
+
+
+@app.get("/rollups/<name>")
+@tracer.capture_method(capture_response=False)
+def get_rollup(name: str):
+    # Without s3:ListBucket a missing key is AccessDenied, not NoSuchKey
+    if name not in ROLLUPS:
+        raise NotFoundError(f"Unknown rollup {name}")
+    rollups_path = os.getenv("ROLLUPS_PATH", "")
+    obj = get_cached_object(f"{rollups_path}/{name}.parquet")
+    return serve_conditional(
+        obj,
+        lambda: Response(
+            status_code=200,
+            content_type=PARQUET_CONTENT_TYPE,
+            body=obj.body,
+        ),
+    )
+
+
+def get_query() -> dict:
+    """Parse the users, start, end and limit query string parameters."""
+    params = app.current_event.query_string_parameters or {}
+    try:
+        end = pd.Timestamp(params["end"]) if "end" in params else pd.Timestamp.now()
+        start = (
+            pd.Timestamp(params["start"])
+            if "start" in params
+            else end - pd.Timedelta(days=DEFAULT_LOOKBACK_DAYS)
+        )
+        limit = int(params.get("limit", DEFAULT_LIMIT))
+    except ValueError as e:
+        raise BadRequestError(str(e))
+    users = params["users"].split(",") if params.get("users") else None
+    return {"users": users, "start": start, "end": end, "limit": limit}
+
+
+def select_rollup(name: str, query: dict) -> pd.DataFrame:
+    table = get_rollups()[name]
+    rows = table[
+        (table["date"] >= query["start"].floor("D")) & (table["date"] <= query["end"])
+    ]
+    if query["users"] is not None:
+        rows = rows[rows["user_name"].isin(query["users"])]
+    return rows
+
+
+def to_records(df: pd.DataFrame) -> list[dict]:
+    return json.loads(df.to_json(orient="records", date_format="iso"))
+
+
+@app.get("/top/<kind>", compress=True)
+@tracer.capture_method(capture_response=False)
+def get_top(kind: str):
+    if kind not in ROLLUPS or kind == "days":
+        raise NotFoundError(f"Unknown top list {kind}")
+    query = get_query()
+    # genres are shown across users, everything else per user
+    keys = ROLLUPS[kind] + ([] if kind == "genres" else ["user_name"])
+    top = (
+        select_rollup(kind, query)
+        .groupby(keys, sort=False)["plays"]
+        .sum()
+        .sort_values(ascending=False, kind="stable")[: query["limit"]]
+        .reset_index()
+    )
+    return {"body": to_records(top)}
+
+
+@app.get("/listens_per_day", compress=True)
+@tracer.capture_method(capture_response=False)
+def get_listens_per_day():
+    query = get_query()
+    rows = select_rollup("days", query)
+    users = query["users"] or sorted(rows["user_name"].unique())
+    grid = pd.MultiIndex.from_product(
+        [users, pd.date_range(query["start"].floor("D"), query["end"], freq="D")],
+        names=["user_name", "date"],
+    )
+    listens = (
+        rows.groupby(["user_name", "date"])["plays"]
+        .sum()
+        .reindex(grid, fill_value=0)
+        .rename("listens")
+        .reset_index()
+    )
+    return {"body": to_records(listens)}
+
+
+@app.get("/metrics", compress=True)
+@tracer.capture_method(capture_response=False)
+def get_metrics():
+    query = get_query()
+    days = select_rollup("days", query)
+    return {
+        "body": {
+            "num_tracks": int(days["plays"].sum()),
+            "distinct_artists": int(
+                select_rollup("artists", query)["artist_name"].nunique()
+            ),
+            "distinct_albums": int(
+                select_rollup("albums", query)["album_name"].nunique()
+            ),
+            "duration_hrs": days["duration_ms"].sum() / 3600000,
+        }
+    }
+
 
 @app.get("/past_month", compress=True)
 @tracer.capture_method(capture_response=False)
 def get_month():
-    bucket_name = os.getenv("BUCKET_NAME", "")
-    past_month_path = os.getenv("PAST_MONTH_PATH", "")
-    obj = json.loads(
-        s3.get_object(Bucket=bucket_name, Key=past_month_path)["Body"].read()
-    )
-    return {"body": obj}
+    return get_fresh(days=30)
 
 
 @app.get("/past_year", compress=True)
 @tracer.capture_method(capture_response=False)
 def get_year():
-    bucket_name = os.getenv("BUCKET_NAME", "")
-    past_year_path = os.getenv("PAST_YEAR_PATH", "")
-    obj = json.loads(
-        s3.get_object(Bucket=bucket_name, Key=past_year_path)["Body"].read()
-    )
-    return {"body": obj}
+    return get_fresh(days=365)
 
 
 @app.get("/todos", compress=True)
 @tracer.capture_method(capture_response=False)
 def get_todos():
-    todos: Response = requests.get("https://jsonplaceholder.typicode.com/todos")
+    todos: RequestsResponse = requests.get("https://jsonplaceholder.typicode.com/todos")
     todos.raise_for_status()
 
     # for brevity, we'll limit to the first 10 only
@@ -50,12 +513,7 @@ def get_todos():
 @app.get("/past_week", compress=True)
 @tracer.capture_method(capture_response=False)
 def get_week():
-    bucket_name = os.getenv("BUCKET_NAME", "")
-    past_week_path = os.getenv("PAST_WEEK_PATH", "")
-    obj = json.loads(
-        s3.get_object(Bucket=bucket_name, Key=past_week_path)["Body"].read()
-    )
-    return {"body": obj}
+    return get_fresh(days=7)
 
 
 @tracer.capture_lambda_handler(capture_response=False)
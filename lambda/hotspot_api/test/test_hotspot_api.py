@@ -0,0 +1,350 @@
+import base64
+import gzip
+import hashlib
+import json
+import os
+from datetime import datetime, timezone
+from io import BytesIO
+from unittest.mock import MagicMock
+
+import pandas as pd
+from botocore.exceptions import ClientError
+from mock import patch
+
+os.environ.setdefault("AWS_DEFAULT_REGION", "eu-west-1")
+
+from hotspot_api import hotspot_api
+from hotspot_api.hotspot_api import PARQUET_CONTENT_TYPE, ROLLUPS, lambda_handler
+
+
+def _to_parquet(df):
+    buffer = BytesIO()
+    df.to_parquet(buffer, index=False)
+    return buffer.getvalue()
+
+
+def _get_rollup(name):
+    df = pd.DataFrame(
+        {
+            "date": pd.to_datetime(["2025-01-01", "2025-01-01", "2025-01-03"]),
+            "user_name": ["Dan", "Theo", "Dan"],
+            "plays": [2, 1, 3],
+            "duration_ms": [3600000, 1800000, 5400000],
+        }
+    )
+    for key in ROLLUPS[name]:
+        df[key] = [f"{key} 1", f"{key} 1", f"{key} 2"]
+    return _to_parquet(df)
+
+
+TODAY = pd.Timestamp.now().normalize()
+PAST_YEAR = pd.DataFrame(
+    {
+        "name": ["a", "b", "c"],
+        "user_name": ["Dan", "Theo", "Dan"],
+        "played_at": TODAY
+        - pd.to_timedelta(["39 days 15 hours", "39 days 14 hours", "1 day 16 hours"]),
+    }
+)
+# A play too old for any window, in its own closed segment
+OLD_PLAY = PAST_YEAR.head(1).assign(name="z", played_at=pd.Timestamp("2000-01-05"))
+
+
+def _get_segments():
+    plays = pd.concat([OLD_PLAY, PAST_YEAR], ignore_index=True)
+    segments, entries = {}, []
+    for name, segment in plays.groupby(plays["played_at"].dt.strftime("%Y-%m")):
+        start = pd.Timestamp(f"{name}-01")
+        end = start + pd.offsets.MonthBegin(1)
+        for user, shard in segment.groupby("user_name"):
+            segments[f"fresh/segments/{name}/{user}.parquet"] = _to_parquet(shard)
+        entries.append(
+            {
+                "name": name,
+                "start": start.isoformat(),
+                "end": end.isoformat(),
+                "closed": end < TODAY - pd.Timedelta(days=7),
+                "rows": len(segment),
+                "users": segment["user_name"].value_counts().to_dict(),
+            }
+        )
+    segments["fresh/segments/manifest.json"] = json.dumps(
+        {"generated_at": TODAY.isoformat(), "segments": entries}
+    ).encode()
+    return segments
+
+
+def _get_windows():
+    # As prep_hotspot_api publishes them
+    windows = {}
+    for days in [7, 30, 365]:
+        window = PAST_YEAR[PAST_YEAR["played_at"] > TODAY - pd.Timedelta(days=days)]
+        body = f'{{"body": {window.reset_index(drop=True).to_json()}}}'
+        windows[f"fresh/windows/{days}.json.gz"] = gzip.compress(body.encode())
+    return windows
+
+
+OBJECTS = _get_segments()
+OBJECTS.update(_get_windows())
+OBJECTS.update({f"fresh/rollups/{name}.parquet": _get_rollup(name) for name in ROLLUPS})
+
+
+def _get_etag(body):
+    return f'"{hashlib.md5(body).hexdigest()}"'
+
+
+def _get_object(Bucket, Key, IfNoneMatch=None):
+    if Key not in OBJECTS:
+        # The API role has no s3:ListBucket, so S3 hides missing keys
+        error = {"Error": {"Code": "AccessDenied", "Message": "Access Denied"}}
+        error["ResponseMetadata"] = {"HTTPStatusCode": 403}
+        raise ClientError(error, "GetObject")
+    etag = _get_etag(OBJECTS[Key])
+    if IfNoneMatch == etag:
+        error = {"Error": {"Code": "304", "Message": "Not Modified"}}
+        error["ResponseMetadata"] = {"HTTPStatusCode": 304}
+        raise ClientError(error, "GetObject")
+    return {
+        "Body": BytesIO(OBJECTS[Key]),
+        "ETag": etag,
+        "LastModified": datetime(2025, 1, 2, 9, tzinfo=timezone.utc),
+    }
+
+
+S3 = MagicMock(get_object=MagicMock(side_effect=_get_object))
+
+
+def _get_event(path, headers=None, params=None):
+    return {
+        "resource": "/{proxy+}",
+        "path": path,
+        "httpMethod": "GET",
+        "headers": headers or {},
+        "multiValueHeaders": {},
+        "queryStringParameters": params,
+        "multiValueQueryStringParameters": None,
+        "pathParameters": {"proxy": path.lstrip("/")},
+        "requestContext": {"httpMethod": "GET", "path": path, "stage": "prod"},
+        "body": None,
+        "isBase64Encoded": False,
+    }
+
+
+def _set_env():
+    os.environ["BUCKET_NAME"] = "bucket-name"
+    os.environ["SEGMENTS_PATH"] = "fresh/segments"
+    os.environ["ROLLUPS_PATH"] = "fresh/rollups"
+    os.environ["WINDOWS_PATH"] = "fresh/windows"
+    os.environ["REVALIDATE_SECONDS"] = "60"
+    hotspot_api._objects.clear()
+    S3.get_object.reset_mock()
+
+
+@patch("hotspot_api.hotspot_api.s3", new=S3)
+def test_past_year_json():
+    _set_env()
+    res = lambda_handler(_get_event("/past_year"), "")
+    assert res["statusCode"] == 200
+    body = json.loads(res["body"])["body"]
+    assert body["name"] == {"0": "a", "1": "b", "2": "c"}
+    assert res["multiValueHeaders"]["ETag"][0].endswith('-identity"')
+    assert res["multiValueHeaders"]["Vary"] == ["Accept, Accept-Encoding"]
+    res = lambda_handler(_get_event("/past_week"), "")
+    assert json.loads(res["body"])["body"]["name"] == {"0": "c"}
+
+
+@patch("hotspot_api.hotspot_api.s3", new=S3)
+def test_past_year_gzip():
+    _set_env()
+    event = _get_event("/past_year", headers={"Accept-Encoding": "gzip, deflate"})
+    res = lambda_handler(event, "")
+    assert res["statusCode"] == 200
+    assert res["isBase64Encoded"]
+    assert res["multiValueHeaders"]["Content-Encoding"] == ["gzip"]
+    assert res["multiValueHeaders"]["Content-Type"] == ["application/json"]
+    # The bytes prep_hotspot_api published, passed through
+    assert base64.b64decode(res["body"]) == OBJECTS["fresh/windows/365.json.gz"]
+    etag = _get_etag(OBJECTS["fresh/windows/365.json.gz"])
+    assert res["multiValueHeaders"]["ETag"] == [etag]
+    assert res["multiValueHeaders"]["Vary"] == ["Accept, Accept-Encoding"]
+    # Nothing is serialised from the segments
+    assert "fresh/segments/manifest.json" not in hotspot_api._objects
+
+
+@patch("hotspot_api.hotspot_api.s3", new=S3)
+def test_past_year_parquet():
+    _set_env()
+    event = _get_event(
+        "/past_year",
+        headers={"Accept": PARQUET_CONTENT_TYPE, "Accept-Encoding": "gzip"},
+    )
+    res = lambda_handler(event, "")
+    assert res["statusCode"] == 200
+    assert res["isBase64Encoded"]
+    assert res["multiValueHeaders"]["Content-Type"] == [PARQUET_CONTENT_TYPE]
+    assert "Content-Encoding" not in res["multiValueHeaders"]
+    df = pd.read_parquet(BytesIO(base64.b64decode(res["body"])))
+    pd.testing.assert_frame_equal(df, PAST_YEAR, check_dtype=False)
+
+
+@patch("hotspot_api.hotspot_api.s3", new=S3)
+def test_rollups():
+    _set_env()
+    res = lambda_handler(_get_event("/rollups/artists"), "")
+    assert res["statusCode"] == 200
+    assert base64.b64decode(res["body"]) == OBJECTS["fresh/rollups/artists.parquet"]
+    res = lambda_handler(_get_event("/rollups/unknown"), "")
+    assert res["statusCode"] == 404
+
+
+@patch("hotspot_api.hotspot_api.s3", new=S3)
+def test_top_artists():
+    _set_env()
+    params = {"users": "Dan,Theo", "start": "2025-01-01", "end": "2025-01-05"}
+    res = lambda_handler(_get_event("/top/artists", params=params), "")
+    top = json.loads(res["body"])["body"]
+    assert [(row["artist_name"], row["plays"]) for row in top] == [
+        ("artist_name 2", 3),
+        ("artist_name 1", 2),
+        ("artist_name 1", 1),
+    ]
+    res = lambda_handler(_get_event("/top/days", params=params), "")
+    assert res["statusCode"] == 404
+
+
+@patch("hotspot_api.hotspot_api.s3", new=S3)
+def test_metrics_and_listens_per_day():
+    _set_env()
+    params = {"users": "Dan", "start": "2025-01-01", "end": "2025-01-03"}
+    res = lambda_handler(_get_event("/metrics", params=params), "")
+    assert json.loads(res["body"])["body"] == {
+        "num_tracks": 5,
+        "distinct_artists": 2,
+        "distinct_albums": 2,
+        "duration_hrs": 2.5,
+    }
+    res = lambda_handler(_get_event("/listens_per_day", params=params), "")
+    listens = json.loads(res["body"])["body"]
+    assert [row["listens"] for row in listens] == [2, 0, 3]
+    res = lambda_handler(_get_event("/metrics", params={"limit": "ten"}), "")
+    assert res["statusCode"] == 400
+
+
+@patch("hotspot_api.hotspot_api.s3", new=S3)
+def test_past_year_since():
+    _set_env()
+    since = str(PAST_YEAR["played_at"][0].value // 1_000_000)
+    event = _get_event(
+        "/past_year", headers={"Accept": PARQUET_CONTENT_TYPE}, params={"since": since}
+    )
+    res = lambda_handler(event, "")
+    df = pd.read_parquet(BytesIO(base64.b64decode(res["body"])))
+    assert df["name"].tolist() == ["b", "c"]
+    res = lambda_handler(_get_event("/past_year", params={"since": since}), "")
+    assert json.loads(res["body"])["body"]["name"] == {"1": "b", "2": "c"}
+
+
+@patch("hotspot_api.hotspot_api.s3", new=S3)
+def test_object_cache_revalidates_by_etag():
+    _set_env()
+    key = "fresh/segments/2000-01/Dan.parquet"
+    frame = hotspot_api.read_parquet_cached(key)
+    # Within the revalidation interval S3 is not called at all
+    assert hotspot_api.read_parquet_cached(key) is frame
+    assert S3.get_object.call_count == 1
+
+    # After it, an unchanged object is kept along with its parsed frame
+    os.environ["REVALIDATE_SECONDS"] = "0"
+    assert hotspot_api.read_parquet_cached(key) is frame
+    assert S3.get_object.call_args.kwargs["IfNoneMatch"] == _get_etag(OBJECTS[key])
+
+    # A changed object is downloaded and parsed again
+    with patch.dict(OBJECTS, {key: _to_parquet(PAST_YEAR.head(1))}):
+        assert len(hotspot_api.read_parquet_cached(key)) == 1
+    assert S3.get_object.call_count == 3
+
+
+@patch("hotspot_api.hotspot_api.s3", new=S3)
+def test_past_year_not_modified():
+    _set_env()
+    headers = {"Accept": PARQUET_CONTENT_TYPE}
+    res = lambda_handler(_get_event("/past_year", headers=headers), "")
+    etag = res["multiValueHeaders"]["ETag"][0]
+    manifest_etag = _get_etag(OBJECTS["fresh/segments/manifest.json"])
+    assert etag == f'{manifest_etag[:-1]}-365"'
+    assert res["multiValueHeaders"]["Last-Modified"] == [
+        "Thu, 02 Jan 2025 09:00:00 GMT"
+    ]
+
+    headers["If-None-Match"] = etag
+    res = lambda_handler(_get_event("/past_year", headers=headers), "")
+    assert res["statusCode"] == 304
+    assert not res["body"]
+
+    # Filtered responses get their own validator
+    params = {"since": "0"}
+    res = lambda_handler(_get_event("/past_year", headers=headers, params=params), "")
+    assert res["statusCode"] == 200
+    headers["If-None-Match"] = res["multiValueHeaders"]["ETag"][0]
+    res = lambda_handler(_get_event("/past_year", headers=headers, params=params), "")
+    assert res["statusCode"] == 304
+
+
+@patch("hotspot_api.hotspot_api.s3", new=S3)
+def test_past_year_users_and_fields():
+    _set_env()
+    params = {"users": "Dan", "fields": "name,played_at"}
+    event = _get_event(
+        "/past_year", headers={"Accept": PARQUET_CONTENT_TYPE}, params=params
+    )
+    res = lambda_handler(event, "")
+    df = pd.read_parquet(BytesIO(base64.b64decode(res["body"])))
+    assert df.columns.tolist() == ["name", "played_at"]
+    assert df["name"].tolist() == ["a", "c"]
+    res = lambda_handler(_get_event("/past_year", params={"fields": "artist_id"}), "")
+    assert res["statusCode"] == 400
+
+    # Selections of users are not cached, so they cannot grow the cache
+    cached = {key: len(obj.derived) for key, obj in hotspot_api._objects.items()}
+    for i in range(20):
+        lambda_handler(_get_event("/past_year", params={"users": f"Dan,junk{i}"}), "")
+    assert {
+        key: len(obj.derived) for key, obj in hotspot_api._objects.items()
+    } == cached
+
+
+@patch("hotspot_api.hotspot_api.s3", new=S3)
+def test_segments():
+    _set_env()
+    res = lambda_handler(_get_event("/segments"), "")
+    manifest = json.loads(res["body"])["body"]
+    assert [segment["rows"] for segment in manifest["segments"]][0] == 1
+
+    res = lambda_handler(_get_event("/segments/2000-01/Dan"), "")
+    assert res["multiValueHeaders"]["Cache-Control"] == [
+        "public, max-age=31536000, immutable"
+    ]
+    df = pd.read_parquet(BytesIO(base64.b64decode(res["body"])))
+    assert df["name"].tolist() == ["z"]
+    current = manifest["segments"][-1]["name"]
+    res = lambda_handler(_get_event(f"/segments/{current}/Dan"), "")
+    assert res["multiValueHeaders"]["Cache-Control"] == ["no-cache"]
+    res = lambda_handler(_get_event("/segments/2000-01/Theo"), "")
+    assert res["statusCode"] == 404
+
+
+@patch("hotspot_api.hotspot_api.s3", new=S3)
+def test_closed_shards_are_not_revalidated():
+    _set_env()
+    os.environ["REVALIDATE_SECONDS"] = "0"
+    params = {"users": "Dan"}
+    for _ in range(2):
+        lambda_handler(_get_event("/segments/2000-01/Dan"), "")
+        lambda_handler(_get_event("/past_year", params=params), "")
+    keys = [call.kwargs["Key"] for call in S3.get_object.call_args_list]
+    assert keys.count("fresh/segments/2000-01/Dan.parquet") == 1
+    months = PAST_YEAR["played_at"].dt.strftime("%Y-%m")
+    closed, current = months[0], months[2]
+    assert keys.count(f"fresh/segments/{closed}/Dan.parquet") == 1
+    # Shards of open segments are checked on every request here
+    assert keys.count(f"fresh/segments/{current}/Dan.parquet") == 2
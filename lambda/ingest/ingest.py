@@ -1,8 +1,12 @@
+import gzip
 import json
 import logging
 import os
+import random
 import sys
-from datetime import datetime
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
 import boto3
 import spotipy
 from spotipy.oauth2 import SpotifyOAuth
@@ -11,6 +15,27 @@ from spotipy.cache_handler import CacheHandler
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
+# Users ingested at once; each mostly waits on Spotify and S3
+MAX_WORKERS = 8
+# DynamoDB limits on keys per BatchGetItem and items per BatchWriteItem
+BATCH_GET_SIZE = 100
+BATCH_WRITE_SIZE = 25
+# Keys and items a batch call left unprocessed are retried after a random
+# wait of up to this long, doubling per retry up to the maximum
+UNPROCESSED_BACKOFF_SECONDS = 0.05
+UNPROCESSED_MAX_BACKOFF_SECONDS = 5
+UNPROCESSED_MAX_RETRIES = 8
+# Spotify's limits on ids per artists call and plays per recently played page
+ARTISTS_SIZE = 50
+PAGE_SIZE = 50
+# Pages followed per user on the hourly schedule, and in backfill mode
+MAX_PAGES = 5
+BACKFILL_MAX_PAGES = 100
+# Version of the landing record written by to_landing_record
+LANDING_SCHEMA_VERSION = 2
+# Genres and images hardly change, so cached artists are refetched monthly
+ARTIST_TTL_SECONDS = 30 * 24 * 60 * 60
+
 
 class MemoryCacheHandler(CacheHandler):
     """
@@ -33,6 +58,22 @@ class MemoryCacheHandler(CacheHandler):
         self.token_info = token_info
 
 
+def with_backoff(call, request, unprocessed):
+    """Responses of the batch ``call`` for ``request``, then for what each
+    response left ``unprocessed``, with exponential backoff and full jitter
+    between the retries."""
+    delay = UNPROCESSED_BACKOFF_SECONDS
+    for _ in range(UNPROCESSED_MAX_RETRIES + 1):
+        response = call(RequestItems=request)
+        yield response
+        request = response.get(unprocessed)
+        if not request:
+            return
+        time.sleep(random.uniform(0, delay))
+        delay = min(delay * 2, UNPROCESSED_MAX_BACKOFF_SECONDS)
+    raise RuntimeError(f"{unprocessed} left after {UNPROCESSED_MAX_RETRIES} retries")
+
+
 class IngestManager:
 
     SCOPE = "user-read-recently-played"
@@ -42,95 +83,330 @@ class IngestManager:
         self._ddb = boto3.resource("dynamodb")
         self.watermark_table_name = os.getenv("WATERMARK_TABLE_NAME")
         self.cache_table_name = os.getenv("CACHE_TABLE_NAME")
+        self.artist_table_name = os.getenv("ARTIST_TABLE_NAME")
         self.bucket_name = os.getenv("BUCKET_NAME")
-        self.watermark_table = self._ddb.Table(self.watermark_table_name)
+        # Keep the raw Spotify responses next to the trimmed landing records
+        self.archive_raw = os.getenv("ARCHIVE_RAW", "false").lower() == "true"
         self.cache_table = self._ddb.Table(self.cache_table_name)
         self._logger = logging.getLogger(__name__)
         self._logger.setLevel(logging.INFO)
 
     def get_caches(self):
-        return self.cache_table.scan()["Items"]
-
-    def get_current_watermark_v2(self, id):
-        response = self.watermark_table.get_item(Key={"id": id})
-        return response["Item"]["watermark"]
-
-    def update_watermark_v2(self, id, new_watermark: str):
-        self._logger.info("Updating watermark")
-        resp = self.watermark_table.update_item(
-            Key={
-                "id": id,
-            },
-            UpdateExpression="SET watermark = :val1",
-            ExpressionAttributeValues={":val1": new_watermark},
-        )
-        self._logger.info(resp)
-
-    def update_cache(self, id, token):
-        self._logger.info(f"Updating cache for {id}")
-        resp = self.cache_table.update_item(
-            Key={
-                "id": id,
-            },
-            UpdateExpression="SET access_token = :val1",
-            ExpressionAttributeValues={":val1": token},
+        """Every item of the cache table, following the scan's pages."""
+        response = self.cache_table.scan()
+        items = response["Items"]
+        while "LastEvaluatedKey" in response:
+            response = self.cache_table.scan(
+                ExclusiveStartKey=response["LastEvaluatedKey"]
+            )
+            items += response["Items"]
+        return items
+
+    def _batch_get(self, table_name, ids):
+        """Items of ``table_name`` by id, read with BatchGetItem. Missing ids
+        are left out.
+
+        Only the low-level client is used, so this is safe to call from the
+        ingest threads.
+        """
+        items = {}
+        ids = list(dict.fromkeys(ids))
+        for start in range(0, len(ids), BATCH_GET_SIZE):
+            request = {
+                table_name: {
+                    "Keys": [{"id": id} for id in ids[start : start + BATCH_GET_SIZE]]
+                }
+            }
+            for response in with_backoff(
+                self._ddb.meta.client.batch_get_item, request, "UnprocessedKeys"
+            ):
+                for item in response["Responses"].get(table_name, []):
+                    items[item["id"]] = item
+        return items
+
+    def get_watermarks(self, ids):
+        """Watermarks of ``ids``, read with BatchGetItem. Missing ids are left out."""
+        return {
+            id: item["watermark"]
+            for id, item in self._batch_get(self.watermark_table_name, ids).items()
+        }
+
+    def get_cached_artists(self, ids):
+        """Spotify artist objects of ``ids`` from the artist cache.
+
+        DynamoDB deletes expired items lazily, so items past their
+        ``expires_at`` are treated as missing.
+        """
+        now = int(time.time())
+        return {
+            id: json.loads(item["artist"])
+            for id, item in self._batch_get(self.artist_table_name, ids).items()
+            if item["expires_at"] > now
+        }
+
+    def put_cached_artists(self, artists):
+        """Store Spotify artist objects in the artist cache, expiring after
+        ARTIST_TTL_SECONDS."""
+        expires_at = int(time.time()) + ARTIST_TTL_SECONDS
+        for start in range(0, len(artists), BATCH_WRITE_SIZE):
+            request = {
+                self.artist_table_name: [
+                    {
+                        "PutRequest": {
+                            "Item": {
+                                "id": artist["id"],
+                                "artist": json.dumps(artist),
+                                "expires_at": expires_at,
+                            }
+                        }
+                    }
+                    for artist in artists[start : start + BATCH_WRITE_SIZE]
+                ]
+            }
+            for _ in with_backoff(
+                self._ddb.meta.client.batch_write_item, request, "UnprocessedItems"
+            ):
+                pass
+
+    def update_user(self, id, watermark=None, token=None):
+        """Store a user's new watermark and token together, in one
+        transaction of their own, so a failure only affects that user."""
+        updates = [
+            (table_name, attribute, value)
+            for table_name, attribute, value in [
+                (self.watermark_table_name, "watermark", watermark),
+                (self.cache_table_name, "access_token", token),
+            ]
+            if value is not None
+        ]
+        if not updates:
+            return
+        self._ddb.meta.client.transact_write_items(
+            TransactItems=[
+                {
+                    "Update": {
+                        "TableName": table_name,
+                        "Key": {"id": id},
+                        "UpdateExpression": "SET #attribute = :val1",
+                        "ExpressionAttributeNames": {"#attribute": attribute},
+                        "ExpressionAttributeValues": {":val1": value},
+                    }
+                }
+                for table_name, attribute, value in updates
+            ]
         )
-        self._logger.info(resp)
 
-    def upload_json(self, bucket, key, data):
+    def upload_json(self, bucket, key, data, compress=False):
         self._logger.info("Uploading json data")
+        body = bytes(json.dumps(data).encode("UTF-8"))
+        extra_args = {}
+        if compress:
+            body = gzip.compress(body)
+            extra_args["ContentEncoding"] = "gzip"
         try:
             self._s3.put_object(
-                Body=bytes(json.dumps(data).encode("UTF-8")),
+                Body=body,
                 Bucket=bucket,
                 Key=key,
                 ContentType="application/json",
+                **extra_args,
             )
         except Exception as e:
             self._logger.error(f"Error while uploading json: {e}")
             raise (Exception)
 
 
+def get_artists(ingest_manager, sp, ids):
+    """Spotify artist objects of ``ids``, deduplicated.
+
+    Artists are read from the shared artist cache first; only unseen or
+    expired ids are fetched from Spotify, in calls of ARTISTS_SIZE ids.
+    """
+    ids = list(dict.fromkeys(ids))
+    artists = ingest_manager.get_cached_artists(ids)
+    missing = [id for id in ids if id not in artists]
+    fetched = []
+    for start in range(0, len(missing), ARTISTS_SIZE):
+        response = sp.artists(missing[start : start + ARTISTS_SIZE])
+        # Spotify returns null for ids it does not know
+        fetched += [artist for artist in response["artists"] if artist]
+    if fetched:
+        ingest_manager.put_cached_artists(fetched)
+    logger.info(f"Fetched {len(fetched)} of {len(ids)} artist(s) from Spotify")
+    artists.update((artist["id"], artist) for artist in fetched)
+    return [artists[id] for id in ids if id in artists]
+
+
+def get_recently_played(sp, watermark, max_pages):
+    """Plays after ``watermark``, following the cursors until caught up or
+    until ``max_pages`` pages were read.
+
+    Returns the plays, the new watermark and the number of pages read.
+    """
+    items, pages = [], 0
+    while pages < max_pages:
+        page = sp.current_user_recently_played(after=watermark, limit=PAGE_SIZE)
+        pages += 1
+        if not page["items"] or not page["cursors"]:
+            break
+        items += page["items"]
+        watermark = page["cursors"]["after"]
+        if len(page["items"]) < PAGE_SIZE:
+            break
+    return items, watermark, pages
+
+
+def get_image_url(images):
+    """Url of the second, medium sized, image, or "" for tracks and artists
+    Spotify has fewer images of."""
+    return images[1]["url"] if len(images) > 1 else ""
+
+
+def to_landing_record(items, artists):
+    """The landing record of ``items``: only the fields transform keeps, with
+    each play's first artist looked up in ``artists`` by id."""
+    artists = {artist["id"]: artist for artist in artists}
+    plays = []
+    for item in items:
+        track = item["track"]
+        artist = artists.get(track["artists"][0]["id"])
+        plays.append(
+            {
+                "duration_ms": track["duration_ms"],
+                "name": track["name"],
+                "album_name": track["album"]["name"],
+                "album_image": get_image_url(track["album"]["images"]),
+                "artist_name": track["artists"][0]["name"],
+                "artist_image": get_image_url(artist["images"]) if artist else "",
+                "artist_id": artist["id"] if artist else "",
+                "genres": ";".join(artist["genres"]) if artist else "",
+                "played_at": item["played_at"],
+            }
+        )
+    return {"schema_version": LANDING_SCHEMA_VERSION, "plays": plays}
+
+
+def ingest_user(ingest_manager, user_name, token_info, watermark, max_pages=MAX_PAGES):
+    """Land the plays of one user since ``watermark`` as one landing object.
+
+    Returns the new watermark and the token info to store for the user.
+    """
+    cache_handler = MemoryCacheHandler(token_info)
+    auth_manager = SpotifyOAuth(cache_handler=cache_handler, scope=ingest_manager.SCOPE)
+    sp = spotipy.Spotify(auth_manager=auth_manager)
+    logger.info(f"API call for {user_name}")
+    items, new_watermark, pages = get_recently_played(sp, watermark, max_pages)
+
+    if not items:
+        logger.info(f"No new tracks for {user_name}")
+        return {
+            "watermark": watermark,
+            "tracks": 0,
+            "pages": pages,
+            "token_info": auth_manager.get_cached_token(),
+        }
+
+    artists = get_artists(
+        ingest_manager, sp, [item["track"]["artists"][0]["id"] for item in items]
+    )
+
+    logger.info(f"Found {len(items)} new track(s) in {pages} page(s) for {user_name}")
+    fname = datetime.now(timezone.utc).strftime(f"{user_name}/%Y/%m/%d/%H-%M.json.gz")
+    ingest_manager.upload_json(
+        ingest_manager.bucket_name,
+        f"landing/{fname}",
+        to_landing_record(items, artists),
+        compress=True,
+    )
+    if ingest_manager.archive_raw:
+        # Outside the landing prefix, so transform is not triggered
+        ingest_manager.upload_json(
+            ingest_manager.bucket_name,
+            f"raw/{fname}",
+            {"items": items, "artists": artists},
+            compress=True,
+        )
+    return {
+        "watermark": new_watermark,
+        "tracks": len(items),
+        "pages": pages,
+        "token_info": auth_manager.get_cached_token(),
+    }
+
+
+def run_user(ingest_manager, cache, watermark, max_pages=MAX_PAGES):
+    """ingest_user with its errors caught and its duration measured."""
+    user_name = cache["id"]
+    start = time.perf_counter()
+    try:
+        result = ingest_user(
+            ingest_manager, user_name, cache["access_token"], watermark, max_pages
+        )
+        result["status"] = "ok"
+    except Exception as e:
+        logger.exception(f"Ingest failed for {user_name}")
+        result = {"status": "error", "error": str(e)}
+    result["user_name"] = user_name
+    result["seconds"] = round(time.perf_counter() - start, 3)
+    return result
+
+
 def lambda_handler(event, context):
+    """Ingest every user's new plays.
+
+    ``event`` may set ``backfill`` to follow up to BACKFILL_MAX_PAGES pages per
+    user instead of MAX_PAGES, and ``users`` to ingest only those users.
+    """
     logger.info(f"Python version: {sys.version}")
+    event = event or {}
+    max_pages = BACKFILL_MAX_PAGES if event.get("backfill") else MAX_PAGES
     ingest_manager = IngestManager()
     # cached tokens for each user
     caches = ingest_manager.get_caches()
+    if event.get("users"):
+        caches = [cache for cache in caches if cache["id"] in event["users"]]
 
-    for cache in caches:
-        user_name = cache["id"]
-        user_token_dict = cache["access_token"]
-        watermark = ingest_manager.get_current_watermark_v2(id=user_name)
-        cache_handler = MemoryCacheHandler(user_token_dict)
-        auth_manager = SpotifyOAuth(
-            cache_handler=cache_handler, scope=ingest_manager.SCOPE
+    # DynamoDB resources are not thread safe, so the watermark and cache
+    # tables are only read and written here, before and after the concurrent
+    # Spotify calls. The threads share the artist cache through the client.
+    watermarks = ingest_manager.get_watermarks([cache["id"] for cache in caches])
+    results = [
+        {"user_name": cache["id"], "status": "error", "error": "No watermark"}
+        for cache in caches
+        if cache["id"] not in watermarks
+    ]
+    caches = [cache for cache in caches if cache["id"] in watermarks]
+
+    max_workers = int(os.getenv("INGEST_MAX_WORKERS", MAX_WORKERS))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        ingested = list(
+            executor.map(
+                lambda cache: run_user(
+                    ingest_manager, cache, watermarks[cache["id"]], max_pages
+                ),
+                caches,
+            )
         )
-        sp = spotipy.Spotify(auth_manager=auth_manager)
-        logger.info(f"API call for {user_name}")
-        rp_json = sp.current_user_recently_played(after=watermark)
 
-        if not rp_json["cursors"]:
-            logger.info("No new tracks")
+    for cache, result in zip(caches, ingested):
+        user_name = cache["id"]
+        token_info = result.pop("token_info", None)
+        if result["status"] != "ok":
             continue
-
-        artists = sp.artists(
-            [item["track"]["artists"][0]["id"] for item in rp_json["items"]]
-        )
-        rp_json["artists"] = artists["artists"]
-
-        new_watermark = rp_json["cursors"]["after"]
-        new_tracks = len(rp_json["items"])
-        logger.info(f"Found {new_tracks} new track(s)")
-        fname = datetime.utcnow().strftime(f"landing/{user_name}/%Y/%m/%d/%H-%M.json")
-        ingest_manager.upload_json(ingest_manager.bucket_name, fname, rp_json)
-        new_token_info = auth_manager.get_cached_token()
-
-        if watermark != new_watermark:
-            ingest_manager.update_watermark_v2(
-                id=user_name, new_watermark=new_watermark
+        watermark = result["watermark"]
+        if cache["access_token"]["access_token"] == token_info["access_token"]:
+            token_info = None
+        try:
+            ingest_manager.update_user(
+                user_name,
+                watermark if watermark != watermarks[user_name] else None,
+                token_info,
             )
+        except Exception as e:
+            # The plays are landed, and are ingested again next run
+            logger.exception(f"Storing the watermark failed for {user_name}")
+            result.update(status="error", error=str(e))
 
-        if user_token_dict["access_token"] != new_token_info["access_token"]:
-            ingest_manager.update_cache(id=user_name, token=new_token_info)
-
-    return "200"
+    results += ingested
+    logger.info(json.dumps(results))
+    return {"status": "200", "users": results}
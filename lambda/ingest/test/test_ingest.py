@@ -1,5 +1,323 @@
-from ingest.ingest import IngestManager
+import gzip
+import json
+import os
+from unittest.mock import MagicMock
+
+import boto3
+import pytest
+from mock import patch
+from moto import mock_aws
+
+os.environ.setdefault("AWS_DEFAULT_REGION", "eu-west-1")
+os.environ.setdefault("AWS_ACCESS_KEY_ID", "testing")
+os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "testing")
+
+from ingest.ingest import (
+    LANDING_SCHEMA_VERSION,
+    PAGE_SIZE,
+    UNPROCESSED_BACKOFF_SECONDS,
+    IngestManager,
+    get_artists,
+    get_recently_played,
+    lambda_handler,
+    to_landing_record,
+    with_backoff,
+)
+
+TOKENS = {
+    "Dan": {"access_token": "dan-token"},
+    "Theo": {"access_token": "theo-token"},
+}
 
 
 def test_ingest_manager():
     assert 1 == 1
+
+
+def _get_recently_played(artist_id):
+    return {
+        "items": [
+            {
+                "track": {
+                    "duration_ms": 231226,
+                    "name": "Workhorse",
+                    "album": {
+                        "name": "Shock Out of Season",
+                        "images": [{"url": "album-640"}, {"url": "album-300"}],
+                    },
+                    "artists": [{"id": artist_id, "name": "Friendship"}],
+                },
+                "played_at": "2025-01-01T09:00:00.000Z",
+            }
+        ],
+        "cursors": {"after": "1735722000000", "before": "1735722000000"},
+    }
+
+
+class StubOAuth:
+    """Auth manager that hands out the cached token without refreshing it."""
+
+    def __init__(self, cache_handler, scope):
+        self.cache_handler = cache_handler
+
+    def get_cached_token(self):
+        return self.cache_handler.get_cached_token()
+
+
+class StubSpotify:
+    """Spotify client whose responses depend on the user's access token."""
+
+    def __init__(self, auth_manager):
+        self.token = auth_manager.cache_handler.get_cached_token()["access_token"]
+
+    def current_user_recently_played(self, after=None, limit=50):
+        if self.token == "theo-token":
+            raise Exception("Token revoked")
+        return _get_recently_played("artist-1")
+
+    def artists(self, ids):
+        return {"artists": [_get_artist(id) for id in ids]}
+
+
+def _get_artist(id):
+    return {
+        "id": id,
+        "genres": ["alt country"],
+        "images": [{"url": f"{id}-640"}, {"url": f"{id}-320"}],
+    }
+
+
+def _create_resources():
+    os.environ["WATERMARK_TABLE_NAME"] = "watermarks"
+    os.environ["CACHE_TABLE_NAME"] = "caches"
+    os.environ["ARTIST_TABLE_NAME"] = "artists"
+    os.environ["BUCKET_NAME"] = "bucket-name"
+    ddb = boto3.resource("dynamodb")
+    for table_name in ["watermarks", "caches", "artists"]:
+        ddb.create_table(
+            TableName=table_name,
+            KeySchema=[{"AttributeName": "id", "KeyType": "HASH"}],
+            AttributeDefinitions=[{"AttributeName": "id", "AttributeType": "S"}],
+            BillingMode="PAY_PER_REQUEST",
+        )
+    for user_name, token in TOKENS.items():
+        ddb.Table("caches").put_item(Item={"id": user_name, "access_token": token})
+        ddb.Table("watermarks").put_item(Item={"id": user_name, "watermark": "0"})
+    boto3.client("s3").create_bucket(
+        Bucket="bucket-name",
+        CreateBucketConfiguration={"LocationConstraint": "eu-west-1"},
+    )
+
+
+@mock_aws
+@patch("ingest.ingest.spotipy.Spotify", new=StubSpotify)
+@patch("ingest.ingest.SpotifyOAuth", new=StubOAuth)
+def test_lambda_handler_isolates_user_errors():
+    _create_resources()
+    res = lambda_handler({}, "")
+
+    users = {user["user_name"]: user for user in res["users"]}
+    assert users["Dan"]["status"] == "ok"
+    assert users["Dan"]["tracks"] == 1
+    assert users["Theo"] == {
+        "user_name": "Theo",
+        "status": "error",
+        "error": "Token revoked",
+        "seconds": users["Theo"]["seconds"],
+    }
+    assert "token_info" not in users["Dan"]
+
+    ingest_manager = IngestManager()
+    assert ingest_manager.get_watermarks(["Dan", "Theo"]) == {
+        "Dan": "1735722000000",
+        "Theo": "0",
+    }
+    keys = boto3.client("s3").list_objects_v2(Bucket="bucket-name")["Contents"]
+    assert [key["Key"].split("/")[1] for key in keys] == ["Dan"]
+    body = boto3.client("s3").get_object(Bucket="bucket-name", Key=keys[0]["Key"])
+    record = json.loads(gzip.decompress(body["Body"].read()))
+    assert record["schema_version"] == LANDING_SCHEMA_VERSION
+    assert record["plays"] == [
+        {
+            "duration_ms": 231226,
+            "name": "Workhorse",
+            "album_name": "Shock Out of Season",
+            "album_image": "album-300",
+            "artist_name": "Friendship",
+            "artist_image": "artist-1-320",
+            "artist_id": "artist-1",
+            "genres": "alt country",
+            "played_at": "2025-01-01T09:00:00.000Z",
+        }
+    ]
+
+
+def test_to_landing_record_without_medium_images():
+    items = _get_recently_played("artist-1")["items"]
+    items[0]["track"]["album"]["images"] = []
+    artist = dict(_get_artist("artist-1"), images=[{"url": "artist-1-640"}])
+    [play] = to_landing_record(items, [artist])["plays"]
+    assert (play["album_image"], play["artist_image"]) == ("", "")
+    assert play["artist_id"] == "artist-1"
+
+
+@mock_aws
+def test_get_watermarks_and_update_user():
+    _create_resources()
+    ingest_manager = IngestManager()
+    assert ingest_manager.get_watermarks(["Dan", "Theo", "Fred"]) == {
+        "Dan": "0",
+        "Theo": "0",
+    }
+
+    ingest_manager.update_user("Dan", "1", {"access_token": "new"})
+    ingest_manager.update_user("Theo", "2")
+    assert ingest_manager.get_watermarks(["Dan", "Theo"]) == {"Dan": "1", "Theo": "2"}
+    caches = {cache["id"]: cache for cache in ingest_manager.get_caches()}
+    assert caches["Dan"]["access_token"] == {"access_token": "new"}
+    assert caches["Theo"]["access_token"] == TOKENS["Theo"]
+
+
+def test_with_backoff_retries_unprocessed_items():
+    responses = [
+        {"UnprocessedItems": {"artists": ["b"]}},
+        {"UnprocessedItems": {"artists": ["b"]}},
+        {"UnprocessedItems": {}},
+    ]
+    call = MagicMock(side_effect=responses)
+    with patch("ingest.ingest.time.sleep") as sleep:
+        assert list(
+            with_backoff(call, {"artists": ["a", "b"]}, "UnprocessedItems")
+        ) == (responses)
+    assert call.call_args.kwargs == {"RequestItems": {"artists": ["b"]}}
+    waits = [wait.args[0] for wait in sleep.call_args_list]
+    assert waits[0] <= UNPROCESSED_BACKOFF_SECONDS
+    assert waits[1] <= 2 * UNPROCESSED_BACKOFF_SECONDS
+
+    call = MagicMock(return_value={"UnprocessedItems": {"artists": ["b"]}})
+    with patch("ingest.ingest.time.sleep"), pytest.raises(RuntimeError):
+        list(with_backoff(call, {"artists": ["b"]}, "UnprocessedItems"))
+
+
+@mock_aws
+@patch("ingest.ingest.spotipy.Spotify", new=StubSpotify)
+@patch("ingest.ingest.SpotifyOAuth", new=StubOAuth)
+def test_lambda_handler_isolates_watermark_failures():
+    _create_resources()
+    token = {"access_token": "theo-ok"}
+    boto3.resource("dynamodb").Table("caches").put_item(
+        Item={"id": "Theo", "access_token": token}
+    )
+    update_user = IngestManager.update_user
+
+    def failing_update_user(self, id, *args):
+        if id == "Theo":
+            raise Exception("Transaction cancelled")
+        return update_user(self, id, *args)
+
+    with patch.object(IngestManager, "update_user", new=failing_update_user):
+        res = lambda_handler({}, "")
+    users = {user["user_name"]: user for user in res["users"]}
+    assert users["Theo"]["status"] == "error"
+    assert users["Dan"]["status"] == "ok"
+    assert IngestManager().get_watermarks(["Dan", "Theo"]) == {
+        "Dan": "1735722000000",
+        "Theo": "0",
+    }
+
+
+class StubArtists:
+    """Spotify client that records the ids of its artists calls."""
+
+    def __init__(self):
+        self.calls = []
+
+    def artists(self, ids):
+        self.calls.append(ids)
+        return {"artists": [{"id": id, "genres": [], "images": []} for id in ids]}
+
+
+@mock_aws
+def test_get_artists_reads_cache_before_spotify():
+    _create_resources()
+    ingest_manager = IngestManager()
+    sp = StubArtists()
+    ids = [f"artist-{i}" for i in range(60)]
+
+    artists = get_artists(ingest_manager, sp, ids + ids[:10])
+    assert [artist["id"] for artist in artists] == ids
+    assert [len(call) for call in sp.calls] == [50, 10]
+
+    sp.calls = []
+    artists = get_artists(ingest_manager, sp, ["artist-new", "artist-0"])
+    assert [artist["id"] for artist in artists] == ["artist-new", "artist-0"]
+    assert sp.calls == [["artist-new"]]
+
+    # Expired artists are fetched again even before DynamoDB deletes them
+    boto3.resource("dynamodb").Table("artists").update_item(
+        Key={"id": "artist-0"},
+        UpdateExpression="SET expires_at = :val1",
+        ExpressionAttributeValues={":val1": 0},
+    )
+    sp.calls = []
+    get_artists(ingest_manager, sp, ["artist-0", "artist-1"])
+    assert sp.calls == [["artist-0"]]
+
+
+class StubHistory:
+    """Spotify client serving ``plays`` played_at values page by page."""
+
+    def __init__(self, plays):
+        self.plays = plays
+        self.calls = 0
+
+    def current_user_recently_played(self, after=None, limit=50):
+        self.calls += 1
+        page = [play for play in self.plays if play > int(after)][:limit]
+        return {
+            "items": [{"played_at": play} for play in page],
+            "cursors": {"after": str(page[-1])} if page else None,
+        }
+
+
+def test_get_recently_played_follows_cursors():
+    sp = StubHistory(list(range(1, 2 * PAGE_SIZE + 11)))
+    items, watermark, pages = get_recently_played(sp, "0", max_pages=5)
+    assert len(items) == 2 * PAGE_SIZE + 10
+    assert watermark == str(2 * PAGE_SIZE + 10)
+    assert pages == sp.calls == 3
+
+    items, watermark, pages = get_recently_played(sp, "0", max_pages=1)
+    assert (len(items), watermark, pages) == (PAGE_SIZE, str(PAGE_SIZE), 1)
+
+    items, watermark, pages = get_recently_played(sp, watermark="1000", max_pages=5)
+    assert (items, watermark, pages) == ([], "1000", 1)
+
+
+@mock_aws
+@patch("ingest.ingest.spotipy.Spotify", new=StubSpotify)
+@patch("ingest.ingest.SpotifyOAuth", new=StubOAuth)
+def test_lambda_handler_backfills_selected_users():
+    _create_resources()
+    res = lambda_handler({"backfill": True, "users": ["Dan"]}, "")
+    assert [user["user_name"] for user in res["users"]] == ["Dan"]
+    assert res["users"][0]["pages"] == 1
+
+
+@mock_aws
+@patch("ingest.ingest.spotipy.Spotify", new=StubSpotify)
+@patch("ingest.ingest.SpotifyOAuth", new=StubOAuth)
+def test_lambda_handler_archives_raw_response():
+    _create_resources()
+    os.environ["ARCHIVE_RAW"] = "true"
+    try:
+        lambda_handler({"users": ["Dan"]}, "")
+    finally:
+        del os.environ["ARCHIVE_RAW"]
+
+    keys = boto3.client("s3").list_objects_v2(Bucket="bucket-name")["Contents"]
+    assert sorted(key["Key"].split("/")[0] for key in keys) == ["landing", "raw"]
+    raw_key = next(key["Key"] for key in keys if key["Key"].startswith("raw/"))
+    body = boto3.client("s3").get_object(Bucket="bucket-name", Key=raw_key)
+    raw = json.loads(gzip.decompress(body["Body"].read()))
+    assert raw["items"] == _get_recently_played("artist-1")["items"]
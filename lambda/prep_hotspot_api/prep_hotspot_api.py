@@ -1,70 +1,444 @@
+import gzip
+import json
 import logging
 import awswrangler as wr
+import duckdb
 import os
+import pandas as pd
 from datetime import datetime, timedelta
+from dateutil.tz import gettz
+from typing import Protocol
 import boto3
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
 boto3.setup_default_session(region_name="eu-west-1")
+s3 = boto3.client("s3")
 
+# Daily rollups served to the dashboard: table name -> entity key columns.
+# Must match ROLLUP_TABLES in lib/utils.py.
+ROLLUPS = {
+    "days": [],
+    "genres": ["genre"],
+    "artists": ["artist_name", "artist_image"],
+    "albums": ["artist_name", "album_name", "album_image"],
+    "tracks": ["name", "artist_name", "album_image"],
+}
 
-def lambda_handler(event, context):
-    logger.info(f"Received event: {event}")
-    try:
-        glue_db = os.getenv("GLUE_DB", "")
-        glue_table = os.getenv("GLUE_TABLE", "")
-        bucket_name = os.getenv("BUCKET_NAME", "")
-        past_week_path = os.getenv("PAST_WEEK_PATH", "")
-        past_month_path = os.getenv("PAST_MONTH_PATH", "")
-        past_year_path = os.getenv("PAST_YEAR_PATH", "")
-        full_df_path = os.getenv("FULL_DF_PATH", "")
-        workgroup = os.getenv("WORKGROUP", "")
-
-        week_ago_datetime = datetime.now() + timedelta(days=-7)
-        week_ago = datetime(
-            week_ago_datetime.year, week_ago_datetime.month, week_ago_datetime.day
+# Rollup days are days of the dashboard's time zone, like its date selector.
+# Must match TIME_ZONE in lib/utils.py.
+TIME_ZONE = "Europe/London"
+
+
+# Columns of the plays table published to fresh/*
+PLAYS_COLUMNS = [
+    "name",
+    "artist_name",
+    "artist_image",
+    "album_name",
+    "album_image",
+    "genres",
+    "duration_ms",
+    "played_at",
+    "user_name",
+]
+
+
+def get_plays_query(
+    glue_table: str, since: pd.Timestamp | None = None, prune: bool = True
+) -> str:
+    """SELECT the plays, only those played from ``since`` if given.
+
+    ``since`` is naive UTC. Unless ``prune`` is False, for a table not
+    partitioned by year and month yet, year and month partition predicates
+    let the backend skip the files of months before the one ``since`` is in.
+    """
+    query = f"SELECT {', '.join(PLAYS_COLUMNS)} FROM {glue_table}"
+    if since is None:
+        return query
+    year, month = since.year, since.month
+    timestamp = since.strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
+    condition = f"played_at >= timestamp '{timestamp}'"
+    if prune:
+        condition = (
+            f"(year > {year} OR (year = {year} AND month >= {month}))"
+            f" AND {condition}"
         )
-        year_ago_datetime = datetime.now() + timedelta(days=-365)
-        year_ago = datetime(
-            year_ago_datetime.year, year_ago_datetime.month, year_ago_datetime.day
+    return f"{query} WHERE {condition}"
+
+
+class QueryBackend(Protocol):
+    """Where the plays table is queried from."""
+
+    def read_sql(self, sql: str) -> pd.DataFrame:
+        """Run ``sql`` against the plays table, with played_at as naive UTC."""
+        ...
+
+    def has_month_partitions(self) -> bool:
+        """Whether the plays table is partitioned by year and month."""
+        ...
+
+
+class AthenaBackend:
+    """The plays table queried through Athena and the Glue catalog."""
+
+    def __init__(self, glue_db: str, glue_table: str, s3_output: str, workgroup: str):
+        self.glue_db = glue_db
+        self.glue_table = glue_table
+        self.s3_output = s3_output
+        self.workgroup = workgroup
+
+    def read_sql(self, sql: str) -> pd.DataFrame:
+        return wr.athena.read_sql_query(
+            sql=sql,
+            database=self.glue_db,
+            ctas_approach=False,
+            s3_output=self.s3_output,
+            workgroup=self.workgroup,
         )
-        month_ago_datetime = datetime.now() + timedelta(days=-30)
-        month_ago = datetime(
-            month_ago_datetime.year, month_ago_datetime.month, month_ago_datetime.day
+
+    def has_month_partitions(self) -> bool:
+        # Not until compact has migrated a table partitioned by user_name only
+        columns = wr.catalog.table(database=self.glue_db, table=self.glue_table)
+        partitions = columns.loc[columns["Partition"], "Column Name"]
+        return {"year", "month"} <= set(partitions)
+
+
+class DuckDBBackend:
+    """The plays table queried in process by DuckDB, straight from its
+    hive-partitioned parquet files (an S3 prefix or a local directory)."""
+
+    def __init__(self, plays_path: str, glue_table: str):
+        self.con = duckdb.connect()
+        self.con.execute("SET TimeZone = 'UTC'")
+        if plays_path.startswith("s3://"):
+            # Lambda only allows writes under /tmp. The image installs httpfs
+            # and aws (for credential_chain) under DUCKDB_EXTENSION_DIRECTORY,
+            # so INSTALL finds them there and nothing is downloaded
+            self.con.execute("SET home_directory = '/tmp'")
+            extension_directory = os.getenv(
+                "DUCKDB_EXTENSION_DIRECTORY", "/tmp/duckdb_extensions"
+            )
+            self.con.execute(f"SET extension_directory = '{extension_directory}'")
+            for extension in ["httpfs", "aws"]:
+                self.con.execute(f"INSTALL {extension}")
+                self.con.execute(f"LOAD {extension}")
+            self.con.execute("CREATE SECRET (TYPE s3, PROVIDER credential_chain)")
+        files = f"{plays_path.rstrip('/')}/**/*.parquet"
+        self.con.execute(
+            f"CREATE VIEW {glue_table} AS SELECT * FROM "
+            f"read_parquet('{files}', hive_partitioning = true, union_by_name = true)"
         )
+        self.glue_table = glue_table
 
-        past_week_query = f"""
-        SELECT name, artist_name, artist_image, album_name, album_image, genres, duration_ms, played_at, user_name FROM {glue_table}
-        """
+    def read_sql(self, sql: str) -> pd.DataFrame:
+        df = self.con.execute(sql).df()
+        # Athena returns naive UTC timestamps
+        if isinstance(df["played_at"].dtype, pd.DatetimeTZDtype):
+            df["played_at"] = df["played_at"].dt.tz_convert(None)
+        return df
 
-        df = wr.athena.read_sql_query(
-            sql=past_week_query,
-            database=glue_db,
-            ctas_approach=False,
+    def has_month_partitions(self) -> bool:
+        # PLAYS_PATH holds the user_name/year/month layout
+        return True
+
+
+def get_backend(bucket_name: str) -> QueryBackend:
+    """The backend named by QUERY_BACKEND: athena (the default) or duckdb."""
+    glue_table = os.getenv("GLUE_TABLE", "")
+    backend = os.getenv("QUERY_BACKEND", "athena")
+    if backend == "duckdb":
+        return DuckDBBackend(os.getenv("PLAYS_PATH", ""), glue_table)
+    if backend == "athena":
+        return AthenaBackend(
+            glue_db=os.getenv("GLUE_DB", ""),
+            glue_table=glue_table,
             s3_output=f"s3://{bucket_name}/athena-query-results/",
-            workgroup=workgroup,
+            workgroup=os.getenv("WORKGROUP", ""),
         )
+    raise ValueError(f"Unknown QUERY_BACKEND {backend}")
+
+
+def to_local_time(played_at: pd.Series) -> pd.Series:
+    """Naive UTC timestamps as naive times of TIME_ZONE."""
+    return (
+        played_at.dt.tz_localize("UTC")
+        .dt.tz_convert(gettz(TIME_ZONE))
+        .dt.tz_localize(None)
+    )
+
+
+def get_local_day(since: pd.Timestamp) -> pd.Timestamp:
+    """The TIME_ZONE day, as naive midnight, that naive UTC ``since`` is in."""
+    return since.tz_localize("UTC").tz_convert(gettz(TIME_ZONE)).normalize()
+
+
+def get_rollups_start(since: pd.Timestamp) -> pd.Timestamp:
+    """Start of the TIME_ZONE day that naive UTC ``since`` is in, as naive UTC.
+
+    Rollups are rebuilt from here, so that day is rebuilt whole even though
+    it can begin before ``since``.
+    """
+    return get_local_day(since).tz_convert("UTC").tz_localize(None)
+
+
+def build_rollups(df: pd.DataFrame) -> dict[str, pd.DataFrame]:
+    """Plays and duration per user, TIME_ZONE day and entity, sorted by date."""
+    plays = df.assign(date=to_local_time(df["played_at"]).dt.normalize())
+    genres = plays.assign(genre=plays["genres"].fillna("").str.split(";")).explode(
+        "genre"
+    )
+    genres = genres[genres["genre"] != ""]
+
+    rollups = {}
+    for name, keys in ROLLUPS.items():
+        source = genres if name == "genres" else plays
+        rollups[name] = (
+            source.groupby(["date", "user_name", *keys], dropna=False)
+            .agg(plays=("played_at", "size"), duration_ms=("duration_ms", "sum"))
+            .reset_index()
+        )
+    return rollups
+
+
+def read_rollups(bucket_name: str, rollups_path: str) -> dict[str, pd.DataFrame] | None:
+    """The rollups published by the previous run, if there was one."""
+    try:
+        return {
+            name: wr.s3.read_parquet(
+                f"s3://{bucket_name}/{rollups_path}/{name}.parquet"
+            )
+            for name in ROLLUPS
+        }
+    except wr.exceptions.NoFilesFound:
+        return None
 
-        past_week = df[df["played_at"] > week_ago]
-        past_month = df[df["played_at"] > month_ago]
-        past_year = df[df["played_at"] > year_ago]
 
-        past_week_result = wr.s3.to_json(
-            past_week, f"s3://{bucket_name}/{past_week_path}"
+def merge_rollups(
+    previous: dict[str, pd.DataFrame], new: dict[str, pd.DataFrame], since: datetime
+) -> dict[str, pd.DataFrame]:
+    """The ``previous`` rollups of the days before the one ``since`` is in,
+    followed by the ``new`` ones, built from every play since that day began
+    (see ``get_rollups_start``)."""
+    day = get_local_day(since).tz_localize(None)
+    return {
+        name: pd.concat(
+            [previous[name][previous[name]["date"] < day], new[name]],
+            ignore_index=True,
         )
-        past_month_result = wr.s3.to_json(
-            past_month, f"s3://{bucket_name}/{past_month_path}"
+        for name in ROLLUPS
+    }
+
+
+# A month segment is closed, and never rewritten, this long after it ends
+SEGMENT_GRACE_DAYS = 7
+
+
+def get_segment_bounds(name: str) -> tuple[pd.Timestamp, pd.Timestamp]:
+    """Start and end of the month a segment named YYYY-MM covers."""
+    start = pd.Timestamp(f"{name}-01")
+    return start, start + pd.offsets.MonthBegin(1)
+
+
+def build_segments(df: pd.DataFrame) -> dict[str, pd.DataFrame]:
+    """Plays split into one segment per calendar month, named YYYY-MM."""
+    months = df["played_at"].dt.strftime("%Y-%m")
+    return {
+        name: segment.reset_index(drop=True)
+        for name, segment in df.groupby(months, sort=True)
+    }
+
+
+def build_manifest(
+    segments: dict[str, pd.DataFrame], now: datetime, previous: dict | None = None
+) -> tuple[dict, list[str]]:
+    """The segments manifest and the names of the segments to (re)write.
+
+    Segments already closed in the ``previous`` manifest keep their entry and
+    are not rewritten, whether or not they are in ``segments``. Every other
+    segment is written, and closed once its month ended more than
+    SEGMENT_GRACE_DAYS ago.
+    """
+    closed = {
+        entry["name"]: entry
+        for entry in (previous or {}).get("segments", [])
+        if entry["closed"]
+    }
+    entries, to_write = dict(closed), []
+    for name, segment in segments.items():
+        if name in closed:
+            continue
+        start, end = get_segment_bounds(name)
+        entries[name] = {
+            "name": name,
+            "start": start.isoformat(),
+            "end": end.isoformat(),
+            "closed": end + timedelta(days=SEGMENT_GRACE_DAYS) <= now,
+            "rows": len(segment),
+            "users": {
+                user: int(rows)
+                for user, rows in segment["user_name"].value_counts().items()
+            },
+        }
+        to_write.append(name)
+    return {
+        "generated_at": now.isoformat(),
+        "segments": [entries[name] for name in sorted(entries)],
+    }, to_write
+
+
+# Days of plays in the JSON windows hotspot_api serves pre-gzipped, as
+# /past_week, /past_month and /past_year
+WINDOW_DAYS = [7, 30, 365]
+
+
+def build_window(
+    segments: dict[str, pd.DataFrame], start: pd.Timestamp
+) -> pd.DataFrame:
+    """Plays after ``start`` from the month ``segments``, in played_at order."""
+    frames = [
+        segment
+        for name, segment in segments.items()
+        if get_segment_bounds(name)[1] > start
+    ]
+    if not frames:
+        return pd.DataFrame(columns=PLAYS_COLUMNS)
+    df = pd.concat(frames, ignore_index=True)
+    df = df[df["played_at"] > start]
+    return df.sort_values("played_at", kind="stable", ignore_index=True)
+
+
+def to_window_body(window: pd.DataFrame) -> bytes:
+    """The gzipped JSON response hotspot_api passes through for a window."""
+    return gzip.compress(f'{{"body": {window.to_json()}}}'.encode())
+
+
+def read_segments(
+    bucket_name: str, segments_path: str, names: list[str]
+) -> dict[str, pd.DataFrame]:
+    """The segments written by earlier runs, read back from their shards."""
+    return {
+        name: wr.s3.read_parquet(f"s3://{bucket_name}/{segments_path}/{name}/")
+        for name in names
+    }
+
+
+def get_open_start(manifest: dict | None) -> pd.Timestamp | None:
+    """Start of the months not closed yet, or None if no month is closed.
+
+    Months close in order, so every play from this time on belongs to an open
+    segment, and every earlier one to a closed segment.
+    """
+    ends = [
+        pd.Timestamp(entry["end"])
+        for entry in (manifest or {}).get("segments", [])
+        if entry["closed"]
+    ]
+    return max(ends) if ends else None
+
+
+def read_manifest(bucket_name: str, key: str) -> dict | None:
+    try:
+        obj = s3.get_object(Bucket=bucket_name, Key=key)
+    except s3.exceptions.NoSuchKey:
+        return None
+    return json.loads(obj["Body"].read())
+
+
+def lambda_handler(event, context):
+    logger.info(f"Received event: {event}")
+    try:
+        glue_table = os.getenv("GLUE_TABLE", "")
+        bucket_name = os.getenv("BUCKET_NAME", "")
+        rollups_path = os.getenv("ROLLUPS_PATH", "")
+        segments_path = os.getenv("SEGMENTS_PATH", "")
+        windows_path = os.getenv("WINDOWS_PATH", "")
+        backend = get_backend(bucket_name)
+
+        # Closed segments are the state carried between runs: only the plays
+        # of open months are queried and held, unless the event asks for a
+        # full refresh
+        manifest_key = f"{segments_path}/manifest.json"
+        previous = None
+        if not (event or {}).get("full_refresh"):
+            previous = read_manifest(bucket_name, manifest_key)
+        since = get_open_start(previous)
+        previous_rollups = None
+        if since is not None:
+            previous_rollups = read_rollups(bucket_name, rollups_path)
+            if previous_rollups is None:
+                # Rollups of the closed months are rebuilt from every play
+                since = None
+
+        # The rollup day the open months start in can begin before them, so
+        # plays are read from the start of that day
+        read_since = None if since is None else get_rollups_start(since)
+        prune = since is not None and backend.has_month_partitions()
+        plays = backend.read_sql(get_plays_query(glue_table, read_since, prune))
+        logger.info(
+            f"Read {len(plays)} plays since {read_since}"
+            f" with {type(backend).__name__}"
         )
-        past_year_result = wr.s3.to_json(
-            past_year, f"s3://{bucket_name}/{past_year_path}"
+        plays = plays.sort_values("played_at", kind="stable", ignore_index=True)
+        df = plays
+        if since is not None:
+            df = plays[plays["played_at"] >= since].reset_index(drop=True)
+
+        # Month segments, sharded by user, from which the API serves every
+        # window. Closed ones are immutable, so only open segments are
+        # rewritten.
+        segments = build_segments(df)
+        manifest, to_write = build_manifest(segments, datetime.now(), previous)
+        for name in to_write:
+            # One shard per user, so clients fetch only the users they show
+            for user, shard in segments[name].groupby("user_name"):
+                shard_result = wr.s3.to_parquet(
+                    shard,
+                    f"s3://{bucket_name}/{segments_path}/{name}/{user}.parquet",
+                    index=False,
+                )
+                logger.info(f"{name} {user} shard write result: {shard_result}")
+
+        # The JSON windows, gzipped once here rather than by the API
+        today = pd.Timestamp.now().normalize()
+        start = today - pd.Timedelta(days=max(WINDOW_DAYS))
+        # Closed segments in the window are not held, as they were not queried
+        names = [
+            entry["name"]
+            for entry in manifest["segments"]
+            if entry["name"] not in segments and pd.Timestamp(entry["end"]) > start
+        ]
+        held = {**segments, **read_segments(bucket_name, segments_path, names)}
+        for days in WINDOW_DAYS:
+            window = build_window(held, today - pd.Timedelta(days=days))
+            s3.put_object(
+                Bucket=bucket_name,
+                Key=f"{windows_path}/{days}.json.gz",
+                Body=to_window_body(window),
+                ContentType="application/json",
+                ContentEncoding="gzip",
+            )
+            logger.info(f"Wrote the {days} day window of {len(window)} plays")
+
+        rollups = build_rollups(plays)
+        if previous_rollups is not None:
+            rollups = merge_rollups(previous_rollups, rollups, since)
+        for name, rollup in rollups.items():
+            rollup_result = wr.s3.to_parquet(
+                rollup, f"s3://{bucket_name}/{rollups_path}/{name}.parquet", index=False
+            )
+            logger.info(f"{name} rollup write result: {rollup_result}")
+
+        # Last: a month the manifest marks closed is not queried again, so the
+        # rollups and shards built from it must be written first. A run that
+        # fails before this point is redone from the previous manifest.
+        s3.put_object(
+            Bucket=bucket_name,
+            Key=manifest_key,
+            Body=json.dumps(manifest).encode(),
+            ContentType="application/json",
         )
-        full_df_result = wr.s3.to_json(df, f"s3://{bucket_name}/{full_df_path}")
-        logger.info(f"Past week write result: {past_week_result}")
-        logger.info(f"Past month write result: {past_month_result}")
-        logger.info(f"Past year write result: {past_year_result}")
-        logger.info(f"Full df write result: {full_df_result}")
         return "200"
     except Exception as e:
         logger.critical(f"An unexpected error occurred: {e}")
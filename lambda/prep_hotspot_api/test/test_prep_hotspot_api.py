@@ -0,0 +1,213 @@
+import gzip
+import json
+import os
+from datetime import datetime
+
+import boto3
+import pandas as pd
+import pytest
+from mock import patch
+from moto import mock_aws
+
+os.environ.setdefault("AWS_DEFAULT_REGION", "eu-west-1")
+os.environ.setdefault("AWS_ACCESS_KEY_ID", "testing")
+os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "testing")
+
+from prep_hotspot_api.prep_hotspot_api import (
+    DuckDBBackend,
+    build_manifest,
+    build_rollups,
+    build_segments,
+    build_window,
+    get_open_start,
+    get_plays_query,
+    get_rollups_start,
+    lambda_handler,
+    merge_rollups,
+    to_window_body,
+)
+
+
+def _get_plays():
+    return pd.DataFrame(
+        {
+            "name": ["a", "b", "a", "c"],
+            "artist_name": ["x", "x", "x", "y"],
+            "artist_image": ["ix", "ix", "ix", "iy"],
+            "album_name": ["p", "p", "p", "q"],
+            "album_image": ["ip", "ip", "ip", "iq"],
+            "genres": ["rock;pop", "rock", "rock;pop", ""],
+            "duration_ms": [1000, 2000, 1000, 4000],
+            "played_at": pd.to_datetime(
+                [
+                    "2025-01-01 09:00",
+                    "2025-01-01 10:00",
+                    "2025-01-02 08:00",
+                    "2025-01-02 09:00",
+                ]
+            ),
+            "user_name": ["Dan", "Dan", "Dan", "Theo"],
+        }
+    )
+
+
+def test_build_rollups():
+    rollups = build_rollups(_get_plays())
+    assert rollups["days"][["user_name", "plays", "duration_ms"]].values.tolist() == [
+        ["Dan", 2, 3000],
+        ["Dan", 1, 1000],
+        ["Theo", 1, 4000],
+    ]
+    genres = rollups["genres"].groupby("genre")["plays"].sum().to_dict()
+    assert genres == {"pop": 2, "rock": 3}
+    tracks = rollups["tracks"]
+    assert tracks[tracks["name"] == "a"]["plays"].tolist() == [1, 1]
+    assert rollups["albums"]["date"].is_monotonic_increasing
+
+
+def test_get_plays_query_since():
+    assert get_plays_query("plays").endswith("FROM plays")
+    query = get_plays_query("plays", pd.Timestamp("2025-02-01"))
+    assert query.endswith(
+        "WHERE (year > 2025 OR (year = 2025 AND month >= 2))"
+        " AND played_at >= timestamp '2025-02-01 00:00:00.000'"
+    )
+    # A table not partitioned by month yet
+    query = get_plays_query("plays", pd.Timestamp("2025-02-01"), prune=False)
+    assert query.endswith("WHERE played_at >= timestamp '2025-02-01 00:00:00.000'")
+
+
+def test_merge_rollups():
+    plays = _get_plays()
+    since = pd.Timestamp("2025-01-02")
+    # The previous run saw one play of the 2nd, this one sees all of them
+    previous = build_rollups(plays.iloc[:3])
+    merged = merge_rollups(previous, build_rollups(plays.iloc[2:]), since)
+    assert merged["days"].equals(build_rollups(plays)["days"])
+    assert merged["genres"]["plays"].sum() == 5
+
+
+def test_rollup_days_are_local():
+    # 23:30 UTC on 30 June is 00:30 on 1 July in London
+    plays = _get_plays().assign(
+        played_at=pd.to_datetime(
+            [
+                "2025-06-30 12:00",
+                "2025-06-30 23:30",
+                "2025-07-01 08:00",
+                "2025-07-01 09:00",
+            ]
+        )
+    )
+    days = build_rollups(plays)["days"]
+    assert days["date"].dt.strftime("%Y-%m-%d").tolist() == [
+        "2025-06-30",
+        "2025-07-01",
+        "2025-07-01",
+    ]
+
+    # The open month starts at midnight UTC, an hour into London's 1 July
+    since = pd.Timestamp("2025-07-01")
+    start = get_rollups_start(since)
+    assert start == pd.Timestamp("2025-06-30 23:00")
+    previous = build_rollups(plays.iloc[:2])
+    new = build_rollups(plays[plays["played_at"] >= start])
+    merged = merge_rollups(previous, new, since)
+    assert merged["days"].equals(days)
+
+
+def test_build_segments_and_manifest():
+    plays = _get_plays()
+    plays.loc[0, "played_at"] = pd.Timestamp("2024-12-31 23:00")
+    segments = build_segments(plays)
+    assert {name: len(segment) for name, segment in segments.items()} == {
+        "2024-12": 1,
+        "2025-01": 3,
+    }
+
+    manifest, to_write = build_manifest(segments, datetime(2025, 1, 5))
+    assert to_write == ["2024-12", "2025-01"]
+    assert [entry["closed"] for entry in manifest["segments"]] == [False, False]
+    assert manifest["segments"][1]["users"] == {"Dan": 2, "Theo": 1}
+
+    # Closed once the grace period has passed, then never rewritten
+    manifest, to_write = build_manifest(segments, datetime(2025, 1, 8), manifest)
+    assert [entry["closed"] for entry in manifest["segments"]] == [True, False]
+    manifest, to_write = build_manifest(segments, datetime(2025, 1, 9), manifest)
+    assert to_write == ["2025-01"]
+    assert manifest["segments"][0]["end"] == "2025-01-01T00:00:00"
+    assert get_open_start(manifest) == pd.Timestamp("2025-01-01")
+
+    # Closed segments are kept when only the open months are read again
+    manifest, to_write = build_manifest(
+        {"2025-01": segments["2025-01"]}, datetime(2025, 1, 10), manifest
+    )
+    assert to_write == ["2025-01"]
+    assert [entry["name"] for entry in manifest["segments"]] == ["2024-12", "2025-01"]
+    assert get_open_start(None) is None
+
+
+def test_build_window():
+    plays = _get_plays()
+    plays.loc[0, "played_at"] = pd.Timestamp("2024-12-31 23:00")
+    segments = build_segments(plays)
+    window = build_window(segments, pd.Timestamp("2025-01-01 09:30"))
+    assert window["name"].tolist() == ["b", "a", "c"]
+    body = json.loads(gzip.decompress(to_window_body(window)))["body"]
+    assert body["name"] == {"0": "b", "1": "a", "2": "c"}
+    assert build_window(segments, pd.Timestamp("2025-02-01")).empty
+
+
+def test_duckdb_backend_over_local_parquet(tmp_path):
+    plays = _get_plays()
+    plays["played_at"] = plays["played_at"].dt.tz_localize("UTC")
+    plays = plays.assign(year=plays["played_at"].dt.year, month=1)
+    plays.to_parquet(tmp_path, partition_cols=["user_name", "year", "month"])
+
+    backend = DuckDBBackend(str(tmp_path), "plays")
+    since = pd.Timestamp("2025-01-02")
+    df = backend.read_sql(get_plays_query("plays", since) + " ORDER BY played_at")
+    assert df["name"].tolist() == ["a", "c"]
+    assert df["played_at"].tolist() == list(plays["played_at"][2:].dt.tz_convert(None))
+
+
+@mock_aws
+def test_lambda_handler_writes_the_manifest_last(tmp_path):
+    plays = _get_plays()
+    plays = plays.assign(year=2025, month=1)
+    plays.to_parquet(tmp_path, partition_cols=["user_name", "year", "month"])
+    env = {
+        "QUERY_BACKEND": "duckdb",
+        "PLAYS_PATH": str(tmp_path),
+        "GLUE_TABLE": "plays",
+        "BUCKET_NAME": "bucket-name",
+        "ROLLUPS_PATH": "fresh/rollups",
+        "SEGMENTS_PATH": "fresh/segments",
+        "WINDOWS_PATH": "fresh/windows",
+    }
+    s3 = boto3.client("s3")
+    s3.create_bucket(
+        Bucket="bucket-name",
+        CreateBucketConfiguration={"LocationConstraint": "eu-west-1"},
+    )
+
+    def get_keys():
+        res = s3.list_objects_v2(Bucket="bucket-name")
+        return {obj["Key"] for obj in res.get("Contents", [])}
+
+    with (
+        patch.dict(os.environ, env),
+        patch("prep_hotspot_api.prep_hotspot_api.s3", new=s3),
+    ):
+        failing = patch(
+            "prep_hotspot_api.prep_hotspot_api.build_rollups",
+            side_effect=RuntimeError("timed out"),
+        )
+        with failing, pytest.raises(RuntimeError):
+            lambda_handler({}, None)
+        assert "fresh/segments/manifest.json" not in get_keys()
+
+        assert lambda_handler({}, None) == "200"
+    keys = get_keys()
+    assert {"fresh/segments/manifest.json", "fresh/rollups/days.parquet"} <= keys
+    assert "fresh/segments/2025-01/Theo.parquet" in keys
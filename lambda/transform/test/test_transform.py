@@ -1,9 +1,25 @@
 from mock import patch
-from transform.transform import lambda_handler
+from moto import mock_aws
+from transform.transform import (
+    LANDING_SCHEMA_VERSION,
+    PARTITION_COLS,
+    TransformManager,
+    lambda_handler,
+)
+import gzip
 import json
 import os
+from io import BytesIO
 from unittest.mock import MagicMock
 
+import awswrangler as wr
+import boto3
+import pandas as pd
+
+os.environ.setdefault("AWS_DEFAULT_REGION", "eu-west-1")
+os.environ.setdefault("AWS_ACCESS_KEY_ID", "testing")
+os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "testing")
+
 
 def read_spotify_response_helper(*args, **kwargs):
     with open("lambda/transform/test/data/res.json", "r") as f:
@@ -30,3 +46,97 @@ def test_lambda_handler():
     event = _get_event()
     res = lambda_handler(event, "")
     assert res == "200"
+
+
+def test_prep_data_adds_time_partitions():
+    res = read_spotify_response_helper()
+    items_df = pd.DataFrame(res["items"]).assign(
+        user_name="Dan", genres="", artist_image="", artist_id=""
+    )
+    track = TransformManager.prep_data(items_df)
+    assert set(PARTITION_COLS) <= set(track.columns)
+    assert (track["year"] == track["played_at"].dt.year).all()
+    assert (track["month"] == track["played_at"].dt.month).all()
+
+
+def test_add_artists_maps_by_id():
+    res = read_spotify_response_helper()
+    item = res["items"][0]
+    other = json.loads(json.dumps(item))
+    other["track"]["artists"][0]["id"] = "unknown"
+    items_df = pd.DataFrame([item, other, item])
+
+    # One artist object per artist id rather than one per play
+    items_df = TransformManager.add_artists(items_df, res["artists"])
+    artist = res["artists"][0]
+    assert items_df["artist_id"].tolist() == [artist["id"], "", artist["id"]]
+    assert items_df["genres"].tolist() == [
+        ";".join(artist["genres"]),
+        "",
+        ";".join(artist["genres"]),
+    ]
+    assert items_df["artist_image"].iloc[1] == ""
+
+
+def test_prep_landing_matches_raw_response():
+    res = read_spotify_response_helper()
+    items_df = pd.DataFrame(res["items"]).assign(user_name="Dan")
+    items_df = TransformManager.add_artists(items_df, res["artists"])
+    expected = TransformManager.prep_data(items_df)
+
+    with open("lambda/transform/test/data/landing.json", "r") as f:
+        record = json.load(f)
+    assert record["schema_version"] == LANDING_SCHEMA_VERSION
+    track = TransformManager.prep_landing(record, "Dan")
+    pd.testing.assert_frame_equal(track, expected)
+
+
+def test_read_spotify_response_decompresses_gzip():
+    transform_manager = TransformManager()
+    body = gzip.compress(json.dumps({"schema_version": 2, "plays": []}).encode())
+    transform_manager.s3 = MagicMock()
+    transform_manager.s3.get_object.return_value = {"Body": BytesIO(body)}
+    record = transform_manager.read_spotify_response(
+        "bucket-name", "landing/Dan/14-00.json.gz"
+    )
+    assert record == {"schema_version": 2, "plays": []}
+
+
+@mock_aws
+def test_push_data_keeps_the_table_layout():
+    os.environ["GLUE_TABLE_NAME"] = "plays"
+    os.environ["GLUE_DB_NAME"] = "hotspot"
+    boto3.client("s3").create_bucket(
+        Bucket="bucket-name",
+        CreateBucketConfiguration={"LocationConstraint": "eu-west-1"},
+    )
+    wr.catalog.create_database("hotspot")
+    res = read_spotify_response_helper()
+    items_df = pd.DataFrame(res["items"]).assign(
+        user_name="Dan", genres="", artist_image="", artist_id=""
+    )
+    track = TransformManager.prep_data(items_df)
+    # A table compact has not migrated to PARTITION_COLS yet
+    wr.s3.to_parquet(
+        track.drop(columns=["year", "month"]),
+        "s3://bucket-name/plays/",
+        dataset=True,
+        partition_cols=["user_name"],
+        database="hotspot",
+        table="plays",
+    )
+
+    transform_manager = TransformManager()
+    transform_manager.glue_table_name = "new_plays"
+    assert transform_manager.get_partition_cols() is None
+    # A missing table is created at PLAYS_PATH in the current layout
+    transform_manager.plays_path = "s3://bucket-name/plays_v2/"
+    transform_manager.push_data(track)
+    assert transform_manager.get_partition_cols() == PARTITION_COLS
+
+    transform_manager.glue_table_name = "plays"
+    assert transform_manager.get_partition_cols() == ["user_name"]
+    transform_manager.push_data(track)
+    df = wr.s3.read_parquet_table(database="hotspot", table="plays")
+    assert len(df) == 2 * len(track)
+    assert "year" not in df.columns
@@ -1,3 +1,4 @@
+import gzip
 import logging
 import json
 import os
@@ -11,7 +12,11 @@ logger.setLevel(logging.INFO)
 boto3.setup_default_session(region_name="eu-west-1")
 s3 = boto3.client("s3")
 
-PARTITION_COLS = ["user_name"]
+# Plays are partitioned by user and by the UTC month they were played in
+PARTITION_COLS = ["user_name", "year", "month"]
+# Version of the trimmed landing record ingest writes; older landing files
+# hold the raw Spotify response
+LANDING_SCHEMA_VERSION = 2
 
 COLS = [
     "duration_ms",
@@ -35,20 +40,13 @@ def lambda_handler(event, context):
     user_name = key.split("/")[1]
     logger.info(f"{bucket}/{key}")
     rp_json = transform_manager.read_spotify_response(bucket=bucket, key=key)
-    items_df = pd.DataFrame(rp_json["items"])
-    items_df["user_name"] = user_name
-
-    if "artists" in rp_json:
-        artists = rp_json["artists"]
-        items_df["genres"] = [";".join(artist["genres"]) for artist in artists]
-        items_df["artist_image"] = [artist["images"][1]["url"] for artist in artists]
-        items_df["artist_id"] = [artist["id"] for artist in artists]
+    if rp_json.get("schema_version") == LANDING_SCHEMA_VERSION:
+        track = transform_manager.prep_landing(rp_json, user_name)
     else:
-        items_df["genres"] = ""
-        items_df["artist_image"] = ""
-        items_df["artist_id"] = ""
-
-    track = transform_manager.prep_data(items_df)
+        items_df = pd.DataFrame(rp_json["items"])
+        items_df["user_name"] = user_name
+        items_df = transform_manager.add_artists(items_df, rp_json.get("artists", []))
+        track = transform_manager.prep_data(items_df)
     res = transform_manager.push_data(track)
     logger.info(json.dumps(res, indent=2))
     return "200"
@@ -58,22 +56,65 @@ class TransformManager:
     def __init__(self):
         self.glue_table_name = os.getenv("GLUE_TABLE_NAME")
         self.glue_db_name = os.getenv("GLUE_DB_NAME")
+        self.plays_path = os.getenv("PLAYS_PATH")
         self.s3 = boto3.client("s3")
+        self.glue = boto3.client("glue")
 
     def read_spotify_response(self, bucket: str, key: str):
         res = self.s3.get_object(Bucket=bucket, Key=key)
-        return json.loads(res["Body"].read())
+        body = res["Body"].read()
+        if key.endswith(".gz"):
+            body = gzip.decompress(body)
+        return json.loads(body)
+
+    def get_partition_cols(self) -> list[str] | None:
+        """The plays table's partition keys, user_name only until compact has
+        migrated it to PARTITION_COLS, or None if there is no table."""
+        try:
+            table = self.glue.get_table(
+                DatabaseName=self.glue_db_name, Name=self.glue_table_name
+            )
+        except self.glue.exceptions.EntityNotFoundException:
+            return None
+        return [key["Name"] for key in table["Table"]["PartitionKeys"]]
 
     def push_data(self, df: pd.DataFrame):
+        partition_cols = self.get_partition_cols()
+        # The write creates a missing table at PLAYS_PATH, in the current layout
+        path = self.plays_path if partition_cols is None else None
+        partition_cols = partition_cols or PARTITION_COLS
+        # Appending partition keys as columns would change the table's schema
+        df = df.drop(
+            columns=[col for col in PARTITION_COLS if col not in partition_cols]
+        )
         return wr.s3.to_parquet(
             df=df,
+            path=path,
             mode="append",
             dataset=True,
-            partition_cols=PARTITION_COLS,
+            partition_cols=partition_cols,
             database=self.glue_db_name,
             table=self.glue_table_name,
         )
 
+    @staticmethod
+    def add_artists(items_df, artists):
+        """Add the genres, image and id of each play's first artist.
+
+        ``artists`` holds Spotify artist objects, matched to plays by id;
+        plays whose artist is missing get empty values.
+        """
+        artists = {artist["id"]: artist for artist in artists}
+        played = [artists.get(track["artists"][0]["id"]) for track in items_df["track"]]
+        items_df["genres"] = [
+            ";".join(artist["genres"]) if artist else "" for artist in played
+        ]
+        items_df["artist_image"] = [
+            artist["images"][1]["url"] if artist else "" for artist in played
+        ]
+        items_df["artist_id"] = [artist["id"] if artist else "" for artist in played]
+        return items_df
+
     @staticmethod
     def prep_data(items_df):
         track = pd.json_normalize(items_df.track)
@@ -87,5 +128,19 @@ class TransformManager:
         track["artist_id"] = items_df.artist_id.copy()
         track["user_name"] = items_df.user_name.copy()
         track["played_at"] = pd.to_datetime(items_df.played_at).copy()
-        track = track[COLS]
-        return track
+        return TransformManager.add_partitions(track[COLS])
+
+    @staticmethod
+    def prep_landing(record, user_name):
+        """The plays of a trimmed landing record, which already holds COLS
+        other than user_name."""
+        track = pd.DataFrame(record["plays"])
+        track["user_name"] = user_name
+        track["played_at"] = pd.to_datetime(track["played_at"])
+        return TransformManager.add_partitions(track[COLS])
+
+    @staticmethod
+    def add_partitions(track):
+        return track.assign(
+            year=track["played_at"].dt.year, month=track["played_at"].dt.month
+        )
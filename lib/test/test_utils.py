@@ -0,0 +1,372 @@
+import json
+import sys
+from datetime import datetime, timedelta
+from io import BytesIO
+from pathlib import Path
+from urllib.parse import unquote
+
+import numpy as np
+import pandas as pd
+import pytest
+import requests
+from mock import patch
+
+from lib.utils import (
+    API_URL,
+    PARQUET_CONTENT_TYPE,
+    PLAYS_FIELDS,
+    GenreIndex,
+    PlaysStore,
+    PlaysView,
+    RollupView,
+    Rollups,
+    build_plays,
+    get_all_tracks,
+    get_listens_per_day,
+    get_metrics,
+    get_top_albums,
+    get_top_artists,
+    get_top_genres,
+    get_plays_store,
+    load_data,
+    read_plays,
+)
+
+sys.path.insert(0, str(Path(__file__).parents[2] / "lambda"))
+from prep_hotspot_api.prep_hotspot_api import build_rollups  # noqa: E402
+
+START = datetime(2025, 1, 1)
+END = datetime(2025, 1, 5)
+
+
+def _get_plays():
+    played_at = [
+        datetime(2024, 12, 31, 12),
+        datetime(2025, 1, 1, 9),
+        datetime(2025, 1, 2, 10),
+        datetime(2025, 1, 2, 11),
+        datetime(2025, 1, 3, 8),
+        datetime(2025, 1, 6, 8),
+    ]
+    df = pd.DataFrame(
+        {
+            "name": ["a", "b", "c", "d", "e", "f"],
+            "artist_name": ["x", "x", "y", "x", "y", "x"],
+            "artist_image": ["ix", "ix", "iy", "ix", "iy", "ix"],
+            "album_name": ["p", "p", "q", "p", "q", "p"],
+            "album_image": ["ip", "ip", "iq", "ip", "iq", "ip"],
+            "genres": ["rock", "rock;pop", "", "rock", "jazz", "rock"],
+            "duration_ms": [1000, 2000, 3000, 4000, 5000, 6000],
+            "played_at": played_at,
+            "user_name": ["Dan", "Dan", "Theo", "Dan", "Fred", "Dan"],
+        }
+    )
+    df["date"] = df["played_at"].dt.date
+    df["year"] = df["played_at"].dt.year
+    df["month"] = df["played_at"].dt.month
+    df["day"] = df["played_at"].dt.day
+    df["hour"] = df["played_at"].dt.hour
+    df["dayofweek"] = df["played_at"].dt.dayofweek
+    return build_plays(df)
+
+
+def _get_dates_index():
+    return pd.DataFrame(
+        {"dates": [(START + timedelta(days=x)).date() for x in range(4)]}
+    )
+
+
+def test_plays_view_selects_users_and_dates():
+    view = PlaysView(_get_plays(), ["Dan", "Theo"], START, END)
+    assert view.rows.tolist() == [1, 2, 3]
+    assert len(view) == 3
+    assert get_all_tracks(view)["duration_ms"].sum() == 9000
+
+
+def test_plays_view_is_slice_when_all_users_selected():
+    view = PlaysView(_get_plays(), ["Dan", "Theo", "Fred"], START, END)
+    assert view.rows == slice(1, 5)
+    assert len(view) == 4
+    assert view.take(["name"])["name"].tolist() == ["b", "c", "d", "e"]
+
+
+def test_aggregations_share_view():
+    view = PlaysView(_get_plays(), ["Dan", "Theo"], START, END)
+    top_artists = get_top_artists(view)
+    assert top_artists[["artist", "user_name", "plays"]].values.tolist() == [
+        ["x", "Dan", 2],
+        ["y", "Theo", 1],
+    ]
+    top_genres = get_top_genres(view)
+    assert dict(zip(top_genres["genre"], top_genres["count"])) == {"rock": 2, "pop": 1}
+
+
+def test_get_listens_per_day_fills_missing_days():
+    view = PlaysView(_get_plays(), ["Dan", "Theo"], START, END)
+    listens = get_listens_per_day(view, dates_index=_get_dates_index())
+    assert listens.shape[0] == 8
+    dan = listens[listens["user"] == "Dan"]["listens"].tolist()
+    assert dan == [1, 1, 0, 0]
+    assert listens["month_year"].unique().tolist() == ["Jan 25"]
+
+
+def test_compact_plays_matches_full_frame():
+    plays = _get_plays()
+    compact = build_plays(plays.frame, compact=True)
+    assert "artist_image" not in compact.frame.columns
+    assert compact.frame["user_name"].dtype == "category"
+    cols = ["name", "artist_name", "album_name", "album_image", "user_name"]
+    rows = slice(1, 5)
+    expected = plays.take(rows, cols)
+    pd.testing.assert_frame_equal(
+        compact.take(rows, cols).astype(object), expected.astype(object)
+    )
+    view = PlaysView(compact, ["Dan", "Theo"], START, END)
+    assert get_top_artists(view)["plays"].tolist() == [2, 1]
+
+
+def test_genre_index_counts_rows():
+    genres = GenreIndex.from_series(pd.Series(["rock;pop", "", None, "pop", "jazz"]))
+    assert genres.vocab.tolist() == ["rock", "pop", "jazz"]
+    assert genres.indptr.tolist() == [0, 2, 2, 2, 3, 4]
+    assert genres.counts(slice(0, 4)).tolist() == [1, 2, 0]
+    assert genres.counts(np.array([0, 4])).tolist() == [1, 1, 1]
+
+
+def _get_response(content: bytes, content_type: str) -> requests.Response:
+    res = requests.Response()
+    res.status_code = 200
+    res._content = content
+    res.headers["Content-Type"] = content_type
+    return res
+
+
+def test_read_plays_parquet_matches_json():
+    frame = _get_plays().frame[["name", "played_at", "user_name"]]
+    buffer = BytesIO()
+    frame.to_parquet(buffer, index=False)
+    from_parquet = read_plays(_get_response(buffer.getvalue(), PARQUET_CONTENT_TYPE))
+    body = json.dumps({"body": json.loads(frame.to_json())}).encode()
+    from_json = read_plays(_get_response(body, "application/json"))
+    pd.testing.assert_frame_equal(
+        from_parquet, from_json.reset_index(drop=True), check_dtype=False
+    )
+
+
+def test_rollup_view_matches_plays_view():
+    plays = _get_plays()
+    args = (["Dan", "Theo"], START, END)
+    plays_view = PlaysView(plays, *args)
+    rollup_view = RollupView(Rollups(tables=build_rollups(plays.frame)), *args)
+    for get_top in [get_top_artists, get_top_albums, get_top_genres]:
+        pd.testing.assert_frame_equal(get_top(rollup_view), get_top(plays_view))
+    assert get_metrics(rollup_view) == get_metrics(plays_view)
+    pd.testing.assert_frame_equal(
+        get_listens_per_day(rollup_view, dates_index=_get_dates_index()),
+        get_listens_per_day(plays_view, dates_index=_get_dates_index()),
+    )
+
+
+def test_plays_append_and_drop_before_match_rebuild():
+    frame = _get_plays().frame
+    cutoff = datetime(2025, 1, 2)
+    for compact in [False, True]:
+        expected = build_plays(frame[frame["played_at"] >= cutoff], compact=compact)
+        plays = (
+            build_plays(frame.iloc[:3], compact=compact)
+            .append(frame.iloc[3:])
+            .drop_before(cutoff)
+        )
+        cols = ["name", "artist_name", "album_image", "user_name", "played_at"]
+        rows = slice(0, len(expected))
+        pd.testing.assert_frame_equal(
+            plays.take(rows, cols).astype(object),
+            expected.take(rows, cols).astype(object),
+        )
+        assert plays.genres.counts(rows).sum() == expected.genres.counts(rows).sum()
+        if compact:
+            assert plays.frame["name"].dtype == "category"
+
+
+class _SegmentsApi:
+    """Serves ``plays`` as month segments, answering 304 to current ETags."""
+
+    def __init__(self, plays: pd.DataFrame, closed: set[str]):
+        self.plays = plays
+        self.closed = closed
+        self.paths = []
+        # Paths answered once with a 502
+        self.failing: set[str] = set()
+
+    def get(self, url: str, headers: dict) -> requests.Response:
+        path = url.removeprefix(f"{API_URL}/")
+        self.paths.append(path)
+        if path in self.failing:
+            self.failing.remove(path)
+            res = _get_response(b"", "text/plain")
+            res.status_code = 502
+            return res
+        months = self.plays["played_at"].dt.strftime("%Y-%m")
+        if path == "segments":
+            segments = [
+                {
+                    "name": month,
+                    "end": (
+                        pd.Timestamp(f"{month}-01") + pd.offsets.MonthBegin(1)
+                    ).isoformat(),
+                    "closed": month in self.closed,
+                    "rows": int((months == month).sum()),
+                    "users": self.plays.loc[months == month, "user_name"]
+                    .value_counts()
+                    .to_dict(),
+                }
+                for month in sorted(months.unique())
+            ]
+            body = json.dumps({"body": {"segments": segments}}).encode()
+            content_type = "application/json"
+        else:
+            buffer = BytesIO()
+            month, user = path.removeprefix("segments/").split("/")
+            shard = (months == month) & (self.plays["user_name"] == unquote(user))
+            self.plays[shard].to_parquet(buffer, index=False)
+            body, content_type = buffer.getvalue(), PARQUET_CONTENT_TYPE
+        etag = f'"{hash(body)}"'
+        if headers.get("If-None-Match") == etag:
+            res = _get_response(b"", content_type)
+            res.status_code = 304
+        else:
+            res = _get_response(body, content_type)
+        res.headers["ETag"] = etag
+        return res
+
+
+def _get_raw_plays() -> pd.DataFrame:
+    raw = _get_plays().frame[PLAYS_FIELDS]
+    december = raw.iloc[:1].assign(played_at=datetime(2024, 12, 31, 9))
+    return pd.concat([december, raw], ignore_index=True)
+
+
+def test_plays_store_fetches_only_new_plays():
+    api = _SegmentsApi(_get_raw_plays(), closed={"2024-12"})
+    store = PlaysStore(compact=True, lookback_days=10000)
+    with patch("lib.utils.requests.get", new=api.get):
+        store.refresh()
+        assert len(store.plays) == 7
+        api.paths.clear()
+        new = api.plays.iloc[-1:].assign(played_at=datetime(2025, 1, 7))
+        api.plays = pd.concat([api.plays, new], ignore_index=True)
+        store.refresh()
+    # The closed December segment is not fetched again
+    assert api.paths[0] == "segments"
+    assert all(path.startswith("segments/2025-01/") for path in api.paths[1:])
+    assert store.watermarks["Dan"] == pd.Timestamp("2025-01-07").value // 1_000_000
+    assert len(store.plays) == 8
+
+
+def test_plays_store_loads_late_plays_of_a_lagging_user():
+    api = _SegmentsApi(_get_raw_plays(), closed={"2024-12"})
+    store = PlaysStore(compact=True, lookback_days=10000)
+    with patch("lib.utils.requests.get", new=api.get):
+        store.refresh()
+        # Theo's play lands after Dan's newer plays were loaded
+        late = api.plays[api.plays["user_name"] == "Theo"].assign(
+            name="late", genres="blues", played_at=datetime(2025, 1, 4)
+        )
+        api.plays = pd.concat([api.plays, late], ignore_index=True)
+        store.refresh()
+    assert len(store.plays) == 8
+    frame = store.plays.frame
+    assert frame["played_at"].is_monotonic_increasing
+    # The play's genres moved with it
+    row = int(np.flatnonzero(frame["name"] == "late")[0])
+    genres = store.plays.genres
+    assert list(genres.vocab[genres.counts(slice(row, row + 1)) > 0]) == ["blues"]
+
+
+def test_plays_store_retries_after_a_failed_shard():
+    api = _SegmentsApi(_get_raw_plays(), closed={"2024-12", "2025-01"})
+    api.failing.add("segments/2025-01/Theo")
+    store = PlaysStore(lookback_days=10000)
+    with patch("lib.utils.requests.get", new=api.get):
+        with pytest.raises(requests.HTTPError):
+            store.refresh()
+        assert (store.plays, store.etag, store.closed) == (None, None, set())
+        store.refresh()
+    assert len(store.plays) == 7
+
+
+def test_plays_store_reuses_plays_when_not_modified():
+    api = _SegmentsApi(_get_raw_plays(), closed=set())
+    store = PlaysStore(lookback_days=10000)
+    with patch("lib.utils.requests.get", new=api.get):
+        store.refresh()
+        plays = store.plays
+        api.paths.clear()
+        store.refresh()
+    assert api.paths == ["segments"]
+    assert store.plays is plays
+
+
+def test_plays_store_fetches_only_selected_users():
+    api = _SegmentsApi(_get_raw_plays(), closed={"2024-12"})
+    store = PlaysStore(lookback_days=10000, user="Theo")
+    with patch("lib.utils.requests.get", new=api.get):
+        store.refresh()
+    assert all(path.endswith("/Theo") for path in api.paths[1:])
+    assert set(store.plays.frame["user_name"]) == {"Theo"}
+
+
+def test_plays_store_loads_on_first_get():
+    api = _SegmentsApi(_get_raw_plays(), closed=set())
+    store = PlaysStore(lookback_days=10000)
+    # time.monotonic() can be below REFRESH_SECONDS shortly after boot
+    with (
+        patch("lib.utils.requests.get", new=api.get),
+        patch("lib.utils.time.monotonic", return_value=1.0),
+    ):
+        assert len(store.get()) == 7
+
+
+def test_load_data_combines_per_user_stores():
+    api = _SegmentsApi(_get_raw_plays(), closed={"2024-12"})
+    with patch("lib.utils.requests.get", new=api.get):
+        for compact in [False, True]:
+            get_plays_store.clear()
+            store = PlaysStore(compact=compact, lookback_days=10000)
+            store.refresh()
+            plays = load_data(compact, 10000, users=["Theo", "Dan", "Fred"])
+            assert load_data(compact, 10000, users=["Dan", "Fred", "Theo"]) is plays
+            rows = slice(0, len(store.plays))
+            # genres are only read through the GenreIndex
+            cols = [col for col in PLAYS_FIELDS if col != "genres"]
+            pd.testing.assert_frame_equal(
+                plays.take(rows, cols).astype(object),
+                store.plays.take(rows, cols).astype(object),
+            )
+            np.testing.assert_array_equal(
+                plays.genres.indptr, store.plays.genres.indptr
+            )
+            np.testing.assert_array_equal(
+                plays.genres.vocab[plays.genres.ids],
+                store.plays.genres.vocab[store.plays.genres.ids],
+            )
+
+            # A user's plays are loaded once, whatever selections include them
+            api.paths.clear()
+            load_data(compact, 10000, users=["Dan"])
+            assert api.paths == []
+
+
+def test_load_data_without_plays_is_empty():
+    api = _SegmentsApi(_get_raw_plays(), closed=set())
+    with patch("lib.utils.requests.get", new=api.get):
+        for compact in [False, True]:
+            get_plays_store.clear()
+            plays = load_data(compact, 10000, users=["Claire"])
+            assert len(plays) == 0
+            view = PlaysView(
+                plays, ["Claire"], datetime(2024, 1, 1), datetime(2026, 1, 1)
+            )
+            assert len(view) == 0
+            assert get_top_artists(view).empty
+            assert get_metrics(view)["num_tracks"] == 0
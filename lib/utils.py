@@ -1,9 +1,42 @@
 import pandas as pd
 import numpy as np
-from datetime import datetime
+import threading
+import time
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from dateutil.tz import gettz
+from io import BytesIO
+from itertools import chain
+from urllib.parse import quote
 import streamlit as st
 import requests
 
+API_URL = "https://ddhry4h9th.execute-api.eu-west-1.amazonaws.com/prod"
+PARQUET_CONTENT_TYPE = "application/vnd.apache.parquet"
+
+# Plays are shown in, and rollup days bucketed by, this time zone.
+# Must match TIME_ZONE in lambda/prep_hotspot_api/prep_hotspot_api.py.
+TIME_ZONE = "Europe/London"
+
+# Plays held in memory are topped up with new plays this often
+REFRESH_SECONDS = 3600
+
+# Columns of the plays the dashboard uses
+PLAYS_FIELDS = [
+    "name",
+    "artist_name",
+    "artist_image",
+    "album_name",
+    "album_image",
+    "genres",
+    "duration_ms",
+    "played_at",
+    "user_name",
+]
+
+# Daily rollups published by prep_hotspot_api, coarsest first
+ROLLUP_TABLES = ["days", "genres", "artists", "albums", "tracks"]
+
 LATEST_TRACKS_COLS = [
     "name",
     "artist_name",
@@ -14,14 +47,250 @@ LATEST_TRACKS_COLS = [
     "album_image",
 ]
 
+# Compact representation: repeated strings become categoricals, calendar
+# fields small integers, and artist/album names and images move into
+# dimension tables referenced by an integer key per play.
+CATEGORY_COLS = ["user_name", "name", "date"]
+CALENDAR_DTYPES = {
+    "year": "int16",
+    "month": "int8",
+    "day": "int8",
+    "hour": "int8",
+    "dayofweek": "int8",
+}
+DIMENSIONS = {
+    # key column: (columns identifying a dimension row, columns it stores)
+    "artist_key": (["artist_name"], ["artist_name", "artist_image"]),
+    "album_key": (["artist_name", "album_name"], ["album_name", "album_image"]),
+}
 
-@st.cache_data(ttl=3600, show_spinner=False)
-def load_data():
-    res = requests.get(
-        "https://ddhry4h9th.execute-api.eu-west-1.amazonaws.com/prod/past_year"
+
+def _ranges(starts: np.ndarray, stops: np.ndarray) -> np.ndarray:
+    """Concatenated ``arange(start, stop)`` for each pair, without a Python loop."""
+    lengths = stops - starts
+    offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+    return offsets + np.arange(lengths.sum())
+
+
+@dataclass
+class GenreIndex:
+    """Genres of each play, parsed once from the ';'-joined ``genres`` column.
+
+    Row ``i`` has the genre ids ``ids[indptr[i]:indptr[i + 1]]`` into ``vocab``.
+    """
+
+    vocab: np.ndarray
+    indptr: np.ndarray
+    ids: np.ndarray
+
+    @staticmethod
+    def _parse(genres: pd.Series, vocab: dict) -> tuple[np.ndarray, np.ndarray]:
+        # Split each distinct genres string once, then expand per row
+        codes, combos = pd.factorize(genres.fillna(""))
+        combo_ids = [
+            [vocab.setdefault(g, len(vocab)) for g in combo.split(";") if g]
+            for combo in combos
+        ]
+        combo_indptr = np.cumsum([0] + [len(ids) for ids in combo_ids])
+        flat = np.fromiter(
+            chain.from_iterable(combo_ids), dtype=np.int32, count=combo_indptr[-1]
+        )
+        starts, stops = combo_indptr[codes], combo_indptr[codes + 1]
+        indptr = np.concatenate([[0], np.cumsum(stops - starts)])
+        return indptr, flat[_ranges(starts, stops)]
+
+    @classmethod
+    def from_series(cls, genres: pd.Series) -> "GenreIndex":
+        vocab = {}
+        indptr, ids = cls._parse(genres, vocab)
+        return cls(vocab=np.array(list(vocab), dtype=object), indptr=indptr, ids=ids)
+
+    def append(self, genres: pd.Series) -> "GenreIndex":
+        vocab = {g: i for i, g in enumerate(self.vocab)}
+        indptr, ids = self._parse(genres, vocab)
+        return GenreIndex(
+            vocab=np.array(list(vocab), dtype=object),
+            indptr=np.concatenate([self.indptr, indptr[1:] + self.indptr[-1]]),
+            ids=np.concatenate([self.ids, ids]),
+        )
+
+    def take(self, rows: np.ndarray) -> "GenreIndex":
+        starts, stops = self.indptr[rows], self.indptr[rows + 1]
+        return GenreIndex(
+            vocab=self.vocab,
+            indptr=np.concatenate([[0], np.cumsum(stops - starts)]),
+            ids=self.ids[_ranges(starts, stops)],
+        )
+
+    def drop_first(self, n: int) -> "GenreIndex":
+        start = self.indptr[n]
+        return GenreIndex(
+            vocab=self.vocab, indptr=self.indptr[n:] - start, ids=self.ids[start:]
+        )
+
+    def counts(self, rows: slice | np.ndarray) -> np.ndarray:
+        if isinstance(rows, slice):
+            ids = self.ids[self.indptr[rows.start] : self.indptr[rows.stop]]
+        else:
+            ids = self.ids[_ranges(self.indptr[rows], self.indptr[rows + 1])]
+        return np.bincount(ids, minlength=len(self.vocab))
+
+
+@dataclass
+class Plays:
+    """Plays sorted by ``played_at``, with the lookup tables built at load time.
+
+    ``dimensions`` maps a key column of ``frame`` to the table its codes index
+    into. It is empty when the frame holds every column directly.
+    """
+
+    frame: pd.DataFrame
+    genres: GenreIndex
+    dimensions: dict[str, pd.DataFrame] = field(default_factory=dict)
+
+    def __len__(self) -> int:
+        return len(self.frame)
+
+    def take(self, rows: slice | np.ndarray, columns: list[str]) -> pd.DataFrame:
+        if not self.dimensions:
+            return self.frame.iloc[rows, self.frame.columns.get_indexer(columns)]
+
+        data = {}
+        for column in columns:
+            if column in self.frame.columns:
+                data[column] = self.frame[column].iloc[rows].array
+                continue
+            for key, table in self.dimensions.items():
+                if column in table.columns:
+                    codes = self.frame[key].iloc[rows].to_numpy()
+                    data[column] = table[column].to_numpy()[codes]
+                    break
+            else:
+                raise KeyError(column)
+        return pd.DataFrame(data, index=self.frame.index[rows])
+
+    def append(self, df: pd.DataFrame) -> "Plays":
+        """Plays with ``df`` added, kept sorted by ``played_at``.
+
+        ``df`` is usually newer than every held play and goes last; a late
+        play older than the newest one held is moved into place.
+        """
+        df = df.sort_values("played_at", kind="stable", ignore_index=True)
+        genres = self.genres.append(df["genres"])
+        if not self.dimensions:
+            frame = pd.concat([self.frame, df], ignore_index=True)
+            return _sorted_plays(Plays(frame=frame, genres=genres))
+        frame, dimensions = _compact_frame(df, self.dimensions)
+        return _sorted_plays(
+            Plays(
+                frame=_concat_compact(self.frame, frame),
+                genres=genres,
+                dimensions=dimensions,
+            )
+        )
+
+    def drop_before(self, cutoff: datetime) -> "Plays":
+        n = self.frame["played_at"].searchsorted(cutoff, side="left")
+        return Plays(
+            frame=self.frame.iloc[n:].reset_index(drop=True),
+            genres=self.genres.drop_first(n),
+            dimensions=self.dimensions,
+        )
+
+
+def _sorted_plays(plays: Plays) -> Plays:
+    played_at = plays.frame["played_at"]
+    if played_at.is_monotonic_increasing:
+        return plays
+    order = np.argsort(played_at.to_numpy(), kind="stable")
+    return Plays(
+        frame=plays.frame.iloc[order].reset_index(drop=True),
+        genres=plays.genres.take(order),
+        dimensions=plays.dimensions,
     )
-    df = pd.DataFrame(res.json()["body"])
-    df["played_at"] = [datetime.fromtimestamp(a / 1000) for a in df["played_at"]]
+
+
+def _compact_frame(
+    df: pd.DataFrame, dimensions: dict[str, pd.DataFrame] | None = None
+) -> tuple[pd.DataFrame, dict]:
+    """Compact ``df``, reusing the codes of existing ``dimensions`` if given."""
+    dimension_cols = [c for _, cols in DIMENSIONS.values() for c in cols]
+    # genres are only read through the GenreIndex
+    frame = df.drop(columns=dimension_cols + ["genres"])
+    new_dimensions = {}
+    for key, (by, cols) in DIMENSIONS.items():
+        keys = pd.MultiIndex.from_frame(df[by].fillna(""))
+        added = df[cols].set_axis(keys)
+        if dimensions:
+            added = added[~keys.isin(dimensions[key].index)]
+        added = added[~added.index.duplicated(keep="last")]
+        table = pd.concat([dimensions[key], added]) if dimensions else added
+        frame[key] = table.index.get_indexer(keys).astype("int32")
+        new_dimensions[key] = table
+    frame = frame.astype(
+        {
+            **{c: "category" for c in CATEGORY_COLS},
+            **CALENDAR_DTYPES,
+            "duration_ms": "int32",
+        }
+    )
+    return frame, new_dimensions
+
+
+def _concat_compact(old: pd.DataFrame, new: pd.DataFrame) -> pd.DataFrame:
+    # Align categories so the concatenated columns stay categorical
+    old = old.copy(deep=False)
+    for column in CATEGORY_COLS:
+        extra = new[column].cat.categories.difference(old[column].cat.categories)
+        old[column] = old[column].cat.add_categories(extra)
+        new[column] = new[column].cat.set_categories(old[column].cat.categories)
+    return pd.concat([old, new], ignore_index=True)
+
+
+def build_plays(df: pd.DataFrame, compact: bool = False) -> Plays:
+    df = df.sort_values("played_at", kind="stable", ignore_index=True)
+    genres = GenreIndex.from_series(df["genres"])
+    if compact:
+        frame, dimensions = _compact_frame(df)
+        return Plays(frame=frame, genres=genres, dimensions=dimensions)
+    return Plays(frame=df, genres=genres)
+
+
+def empty_plays(compact: bool = False) -> Plays:
+    """Plays with no rows, for a selection nothing has been played by yet."""
+    df = pd.DataFrame({column: pd.Series(dtype=object) for column in PLAYS_FIELDS})
+    df["duration_ms"] = df["duration_ms"].astype("int64")
+    df["played_at"] = pd.Series(dtype="datetime64[ns, UTC]")
+    return build_plays(add_calendar_columns(df), compact=compact)
+
+
+def local_now() -> datetime:
+    """The current time in TIME_ZONE, as a naive datetime."""
+    return datetime.now(gettz(TIME_ZONE)).replace(tzinfo=None)
+
+
+def _to_local_time(played_at: pd.Series) -> pd.Series:
+    """UTC timestamps as naive times of TIME_ZONE."""
+    if played_at.dt.tz is None:
+        played_at = played_at.dt.tz_localize("UTC")
+    # A tzfile zone converts vectorised; tzlocal() would go row by row
+    return played_at.dt.tz_convert(gettz(TIME_ZONE)).dt.tz_localize(None)
+
+
+def read_plays(res: requests.Response) -> pd.DataFrame:
+    """Plays from an API response, with ``played_at`` as UTC timestamps."""
+    if res.headers.get("Content-Type") == PARQUET_CONTENT_TYPE:
+        df = pd.read_parquet(BytesIO(res.content))
+        if df["played_at"].dt.tz is None:
+            df["played_at"] = df["played_at"].dt.tz_localize("UTC")
+    else:
+        df = pd.DataFrame(res.json()["body"])
+        df["played_at"] = pd.to_datetime(df["played_at"], unit="ms", utc=True)
+    return df
+
+
+def add_calendar_columns(df: pd.DataFrame) -> pd.DataFrame:
+    df["played_at"] = _to_local_time(df["played_at"])
     df["date"] = df["played_at"].dt.date
     df["year"] = df["played_at"].dt.year
     df["month"] = df["played_at"].dt.month
@@ -31,120 +300,424 @@ def load_data():
     return df
 
 
-def get_top_artists(df: pd.DataFrame, user_names: list, start: datetime, end: datetime):
-    return (
-        df[["artist_name", "artist_image", "user_name"]][
-            df["user_name"].isin(user_names)
-        ][df["played_at"] > start][df["played_at"] <= end]
-        .value_counts()
-        .to_frame()
-        .reset_index(drop=False)
-        .rename(columns={"artist_name": "artist", "count": "plays"})
-    )
+class PlaysStore:
+    """Plays kept in memory across reruns, loaded from the API's month segments.
 
+    Only the shards of ``user`` (every user if None) are fetched. Closed
+    segments never change, so each shard is downloaded once. Open ones are
+    revalidated by ETag, and only plays newer than the newest one held for the
+    shard's user (the user's watermark) are appended from them. Ingestion of
+    one user can lag another's, so each user keeps their own watermark. Plays
+    older than the lookback window are evicted.
+    """
 
-def get_top_tracks(df: pd.DataFrame, user_names: list, start: datetime, end: datetime):
-    return (
-        df[["name", "artist_name", "album_image", "user_name"]][
-            df["user_name"].isin(user_names)
-        ][df["played_at"] > start][df["played_at"] <= end]
-        .value_counts()
-        .to_frame()
-        .reset_index(drop=False)
+    def __init__(
+        self,
+        compact: bool = False,
+        lookback_days: int = 365,
+        user: str | None = None,
+    ):
+        self.compact = compact
+        self.lookback_days = lookback_days
+        self.user = user
+        self.plays: Plays | None = None
+        # Newest played_at held per user, in epoch ms
+        self.watermarks: dict[str, int] = {}
+        self.etag: str | None = None
+        self.segment_etags: dict[str, str] = {}
+        self.closed: set[str] = set()
+        self.refreshed_at: float | None = None
+        self._lock = threading.Lock()
+
+    def get(self) -> Plays:
+        with self._lock:
+            if (
+                self.refreshed_at is None
+                or time.monotonic() - self.refreshed_at > REFRESH_SECONDS
+            ):
+                self.refresh()
+        if self.plays is None:
+            return empty_plays(compact=self.compact)
+        return self.plays
+
+    def refresh(self) -> None:
+        res = _get_conditional("segments", self.etag)
+        if res.status_code != 304:
+            self.load_segments(res.json()["body"]["segments"])
+            # Only once every segment is loaded, so a failed shard is fetched
+            # again by the next refresh
+            self.etag = res.headers.get("ETag")
+        self.refreshed_at = time.monotonic()
+
+    def load_segments(self, segments: list[dict]) -> None:
+        """Load the shards of ``segments`` that changed since the last load.
+
+        ETags, closed segments and watermarks are only recorded once the
+        plays are merged, so a failed request leaves the store as it was.
+        """
+        cutoff = datetime.combine(
+            local_now() - timedelta(days=self.lookback_days), datetime.min.time()
+        )
+        frames, etags, closed = [], {}, set()
+        for segment in segments:
+            name = segment["name"]
+            # Segment bounds are UTC, so allow a day either side of the cutoff
+            end = pd.Timestamp(segment["end"])
+            if name in self.closed or end < cutoff - timedelta(days=1):
+                continue
+            for user in segment["users"]:
+                if self.user is not None and user != self.user:
+                    continue
+                path = f"segments/{name}/{quote(user)}"
+                res = _get_conditional(path, self.segment_etags.get(path))
+                if res.status_code == 304:
+                    continue
+                etags[path] = res.headers.get("ETag")
+                shard = read_plays(res)[PLAYS_FIELDS]
+                if user in self.watermarks:
+                    since = pd.Timestamp(self.watermarks[user], unit="ms", tz="UTC")
+                    shard = shard[shard["played_at"] > since]
+                frames.append(shard)
+            if segment["closed"]:
+                closed.add(name)
+
+        if frames:
+            df = pd.concat(frames, ignore_index=True)
+            watermarks = {
+                user: played_at.value // 1_000_000
+                for user, played_at in df.groupby("user_name")["played_at"]
+                .max()
+                .items()
+            }
+            df = add_calendar_columns(df)
+            if self.plays is None:
+                plays = build_plays(df, compact=self.compact)
+            else:
+                plays = self.plays.append(df)
+            self.plays = plays.drop_before(cutoff)
+            self.watermarks.update(watermarks)
+        self.segment_etags.update(etags)
+        self.closed |= closed
+
+
+def _get_conditional(path: str, etag: str | None = None) -> requests.Response:
+    """GET an API path, letting it answer 304 if ``etag`` is still current."""
+    headers = {"Accept": PARQUET_CONTENT_TYPE}
+    if etag is not None:
+        headers["If-None-Match"] = etag
+    res = requests.get(f"{API_URL}/{path}", headers=headers)
+    res.raise_for_status()
+    return res
+
+
+# Keyed by user, who come from the dashboard's selector
+@st.cache_resource(show_spinner=False)
+def get_plays_store(
+    compact: bool = False,
+    lookback_days: int = 365,
+    user: str | None = None,
+) -> PlaysStore:
+    return PlaysStore(compact=compact, lookback_days=lookback_days, user=user)
+
+
+def concat_plays(parts: list[Plays]) -> Plays:
+    """The plays of every part in one Plays, sorted by ``played_at``."""
+    vocab = {}
+    indptrs, ids, offset = [np.array([0])], [], 0
+    for part in parts:
+        codes = [vocab.setdefault(genre, len(vocab)) for genre in part.genres.vocab]
+        ids.append(np.array(codes, dtype=np.int32)[part.genres.ids])
+        indptrs.append(part.genres.indptr[1:] + offset)
+        offset += part.genres.indptr[-1]
+    genres = GenreIndex(
+        vocab=np.array(list(vocab), dtype=object),
+        indptr=np.concatenate(indptrs),
+        ids=np.concatenate(ids),
     )
+    if not parts[0].dimensions:
+        frame = pd.concat([part.frame for part in parts], ignore_index=True)
+        return _sorted_plays(Plays(frame=frame, genres=genres))
+
+    # Codes of each part's dimension tables are remapped into shared tables
+    frames = [part.frame.copy(deep=False) for part in parts]
+    dimensions = {}
+    for key in parts[0].dimensions:
+        tables = [part.dimensions[key] for part in parts]
+        table = pd.concat(tables)
+        table = table[~table.index.duplicated(keep="last")]
+        for frame, part_table in zip(frames, tables):
+            codes = table.index.get_indexer(part_table.index).astype("int32")
+            frame[key] = codes[frame[key].to_numpy()]
+        dimensions[key] = table
+    frame = frames[0]
+    for other in frames[1:]:
+        frame = _concat_compact(frame, other)
+    return _sorted_plays(Plays(frame=frame, genres=genres, dimensions=dimensions))
+
+
+# Recent combinations returned by load_data, keyed by the per-user Plays
+# they were built from, so reruns with an unchanged selection reuse them
+COMBINED_ENTRIES = 2
+_combined: list[tuple[tuple[Plays, ...], Plays]] = []
+_combined_lock = threading.Lock()
+
+
+def _combine_plays(parts: tuple[Plays, ...]) -> Plays:
+    if len(parts) == 1:
+        return parts[0]
+    with _combined_lock:
+        for key, plays in _combined:
+            if len(key) == len(parts) and all(a is b for a, b in zip(key, parts)):
+                return plays
+    plays = concat_plays(list(parts))
+    with _combined_lock:
+        _combined.append((parts, plays))
+        del _combined[:-COMBINED_ENTRIES]
+    return plays
+
+
+def load_data(
+    compact: bool = False, lookback_days: int = 365, users: list[str] | None = None
+) -> Plays:
+    """Plays of ``users`` (every user if None), kept across reruns.
 
+    Each user's plays are held and refreshed once, whatever selections they
+    are part of, and combined for the selection on demand.
+    """
+    if users is None:
+        return get_plays_store(compact=compact, lookback_days=lookback_days).get()
+    parts = [
+        get_plays_store(compact=compact, lookback_days=lookback_days, user=user).get()
+        for user in sorted(set(users))
+    ]
+    parts = tuple(part for part in parts if len(part))
+    if not parts:
+        return empty_plays(compact=compact)
+    return _combine_plays(parts)
 
-def get_top_albums(df: pd.DataFrame, user_names: list, start: datetime, end: datetime):
+
+def _grid_counts(
+    user_names: list,
+    days: pd.DatetimeIndex,
+    users: pd.Series,
+    dates: pd.Series,
+    weights: pd.Series | None = None,
+) -> np.ndarray:
+    """Counts for every (user, day) cell of the grid, flattened user-major."""
+    user_pos = pd.Categorical(users, categories=user_names).codes
+    day_pos = days.get_indexer(dates)
+    in_grid = (user_pos >= 0) & (day_pos >= 0)
+    cells = user_pos[in_grid].astype(np.int64) * len(days) + day_pos[in_grid]
+    if weights is not None:
+        weights = weights.to_numpy()[in_grid]
+    counts = np.bincount(cells, weights=weights, minlength=len(user_names) * len(days))
+    return counts.astype(np.int64)
+
+
+def _sorted_counts(counts: pd.Series) -> pd.DataFrame:
     return (
-        df[["artist_name", "album_name", "album_image", "user_name"]][
-            df["user_name"].isin(user_names)
-        ][df["played_at"] > start][df["played_at"] <= end]
-        .value_counts()
+        counts.rename("count")
+        .sort_values(ascending=False, kind="stable")
         .to_frame()
         .reset_index(drop=False)
     )
 
 
-def get_top_genres(df: pd.DataFrame, user_names: list, start: datetime, end: datetime):
-    genres_df = (
-        df["genres"][df["user_name"].isin(user_names)][df["played_at"] > start][
-            df["played_at"] <= end
-        ]
-        .replace("", np.nan)
-        .dropna()
-        .reset_index(drop=True)
-    )
+class PlaysView:
+    """Rows of the plays selected by user and date range.
 
-    return (
-        pd.Series([x for genres in genres_df for x in genres.split(";")])
-        .value_counts()[:10]
-        .to_frame()
-        .reset_index()
-        .rename(columns={"index": "genre"})
-    )
+    The frame must be sorted by ``played_at``, as returned by ``load_data``, so
+    the date range is found by binary search. The selection is built once and
+    its rows are shared by every aggregation. ``rows`` is a slice of the frame
+    when every play in the date range belongs to a selected user, otherwise an
+    array of row positions.
+    """
 
+    def __init__(self, plays: Plays, user_names: list, start: datetime, end: datetime):
+        self.plays = plays
+        df = plays.frame
+        self.user_names = user_names
+        self.start = start
+        self.end = end
+        played_at = df["played_at"]
+        lo = played_at.searchsorted(start, side="right")
+        hi = played_at.searchsorted(end, side="right")
+        users = df["user_name"].iloc[lo:hi].isin(user_names).to_numpy()
+        if users.all():
+            self.rows = slice(lo, hi)
+        else:
+            self.rows = lo + np.flatnonzero(users)
 
-def get_all_tracks(df: pd.DataFrame, user_names: list, start: datetime, end: datetime):
-    return df[["name", "duration_ms"]][df["user_name"].isin(user_names)][
-        df["played_at"] > start
-    ][df["played_at"] <= end].reset_index(drop=False)
+    def __len__(self) -> int:
+        if isinstance(self.rows, slice):
+            return self.rows.stop - self.rows.start
+        return len(self.rows)
 
+    def take(self, columns: list[str]) -> pd.DataFrame:
+        return self.plays.take(self.rows, columns)
 
-def get_listens_per_day(
-    df: pd.DataFrame,
-    user_names: list,
-    start: datetime,
-    end: datetime,
-    dates_index: pd.DataFrame,
-):
-    final_dfs = []
-    for user in user_names:
-        transformed = (
-            df[df["user_name"] == user][df["played_at"] > start][df["played_at"] <= end]
-            .groupby("date")
-            .size()
-            .to_frame()
-            .rename(columns={0: "listens"})
-            .astype({"listens": int})
+    def count(self, columns: list[str]) -> pd.DataFrame:
+        """Plays per distinct value of ``columns``, most played first."""
+        return _sorted_counts(
+            self.take(columns).groupby(columns, observed=True, sort=False).size()
         )
-        merged = (
-            pd.merge(
-                transformed,
-                dates_index,
-                how="right",
-                left_index=True,
-                right_on="dates",
+
+    def genre_counts(self) -> pd.Series:
+        genres = self.plays.genres
+        return pd.Series(genres.counts(self.rows), index=genres.vocab)
+
+    def day_counts(self, days: pd.DatetimeIndex) -> np.ndarray:
+        plays = self.take(["user_name", "played_at"])
+        return _grid_counts(
+            self.user_names,
+            days,
+            plays["user_name"],
+            plays["played_at"].dt.normalize(),
+        )
+
+    def duration_ms(self) -> int:
+        return int(self.take(["duration_ms"])["duration_ms"].sum())
+
+
+@dataclass
+class Rollups:
+    """Daily rollup tables built by prep_hotspot_api, each sorted by ``date``.
+
+    Every table has ``user_name``, ``date``, ``plays`` and ``duration_ms`` plus
+    the key columns of the entity it counts, one row per user, day and entity.
+    """
+
+    tables: dict[str, pd.DataFrame]
+
+
+class RollupView:
+    """Rollup rows selected by user and date range.
+
+    Answers the same queries as ``PlaysView`` by summing the daily rollups, so
+    its cost grows with distinct items per day rather than with plays. The
+    range is widened to whole days.
+    """
+
+    def __init__(
+        self, rollups: Rollups, user_names: list, start: datetime, end: datetime
+    ):
+        self.rollups = rollups
+        self.user_names = user_names
+        self.start = start
+        self.end = end
+        self._selected = {}
+
+    def select(self, name: str) -> pd.DataFrame:
+        if name not in self._selected:
+            table = self.rollups.tables[name]
+            lo = table["date"].searchsorted(
+                pd.Timestamp(self.start).floor("D"), side="left"
             )
-            .set_index("dates")
-            .replace(np.nan, 0)
-            .assign(user=user)
+            hi = table["date"].searchsorted(self.end, side="right")
+            rows = table.iloc[lo:hi]
+            self._selected[name] = rows[rows["user_name"].isin(self.user_names)]
+        return self._selected[name]
+
+    def __len__(self) -> int:
+        return int(self.select("days")["plays"].sum())
+
+    def count(self, columns: list[str]) -> pd.DataFrame:
+        """Plays per distinct value of ``columns``, most played first."""
+        # The first (coarsest) table that has every requested column
+        name = next(
+            name
+            for name in ROLLUP_TABLES
+            if set(columns) <= set(self.rollups.tables[name].columns)
+        )
+        return _sorted_counts(
+            self.select(name).groupby(columns, sort=False)["plays"].sum()
+        )
+
+    def genre_counts(self) -> pd.Series:
+        return self.select("genres").groupby("genre", sort=False)["plays"].sum()
+
+    def day_counts(self, days: pd.DatetimeIndex) -> np.ndarray:
+        rows = self.select("days")
+        return _grid_counts(
+            self.user_names, days, rows["user_name"], rows["date"], rows["plays"]
         )
-        final_dfs.append(merged)
 
-    final_df = pd.concat(final_dfs, axis=0)
+    def duration_ms(self) -> int:
+        return int(self.select("days")["duration_ms"].sum())
+
 
-    final_df["date"] = pd.to_datetime(final_df.index)
-    final_df["month_year"] = final_df["date"].dt.strftime("%b %y")
-    return final_df
+View = PlaysView | RollupView
 
 
-def get_listens_by_hour_of_day(
-    df: pd.DataFrame, user_names: list, start: datetime, end: datetime, num_tracks: int
-):
+@st.cache_data(ttl=3600, show_spinner=False)
+def load_rollups() -> Rollups:
+    tables = {}
+    for name in ROLLUP_TABLES:
+        res = requests.get(
+            f"{API_URL}/rollups/{name}", headers={"Accept": PARQUET_CONTENT_TYPE}
+        )
+        res.raise_for_status()
+        tables[name] = pd.read_parquet(BytesIO(res.content)).sort_values(
+            "date", kind="stable", ignore_index=True
+        )
+    return Rollups(tables=tables)
+
+
+def get_top_artists(view: View):
+    return view.count(["artist_name", "artist_image", "user_name"]).rename(
+        columns={"artist_name": "artist", "count": "plays"}
+    )
+
+
+def get_top_tracks(view: View):
+    return view.count(["name", "artist_name", "album_image", "user_name"])
+
+
+def get_top_albums(view: View):
+    return view.count(["artist_name", "album_name", "album_image", "user_name"])
+
+
+def get_top_genres(view: View):
+    counts = view.genre_counts()
+    counts = counts[counts > 0].sort_values(ascending=False, kind="stable")[:10]
+    return pd.DataFrame({"genre": counts.index, "count": counts.to_numpy()})
+
+
+def get_metrics(view: View) -> dict:
+    return {
+        "num_tracks": len(view),
+        "distinct_artists": len(view.count(["artist_name"])),
+        "distinct_albums": len(view.count(["album_name"])),
+        "duration_hrs": view.duration_ms() / 3600000,
+    }
+
+
+def get_all_tracks(view: PlaysView):
+    return view.take(["name", "duration_ms"]).reset_index(drop=False)
+
+
+def get_listens_per_day(view: View, dates_index: pd.DataFrame):
+    users = np.array(view.user_names, dtype=object)
+    days = pd.DatetimeIndex(dates_index["dates"])
+    listens = view.day_counts(days)
+
+    months, month_labels = pd.factorize(days.to_period("M"))
+    return pd.DataFrame(
+        {
+            "listens": listens,
+            "user": np.repeat(users, len(days)),
+            "date": np.tile(days, len(users)),
+            "month_year": np.tile(month_labels.strftime("%b %y")[months], len(users)),
+        },
+        index=pd.Index(np.tile(dates_index["dates"], len(users)), name="dates"),
+    )
+
+
+def get_listens_by_hour_of_day(view: PlaysView, num_tracks: int):
     return (
-        df[df["user_name"].isin(user_names)][df["played_at"] > start][
-            df["played_at"] <= end
-        ]
-        .hour.value_counts()
-        .sort_index()
-        / num_tracks
-        * 100
+        view.take(["hour"])["hour"].value_counts().sort_index() / num_tracks * 100
     ).reset_index()
 
 
-def get_latest_tracks(
-    df: pd.DataFrame, user_names: list, start: datetime, end: datetime
-):
-    return df.sort_values(by="played_at", ascending=False)[LATEST_TRACKS_COLS][
-        df["user_name"].isin(user_names)
-    ][df["played_at"] > start][df["played_at"] <= end].reset_index(drop=True)
+def get_latest_tracks(view: PlaysView):
+    return view.take(LATEST_TRACKS_COLS).iloc[::-1].reset_index(drop=True)